@@ -0,0 +1,397 @@
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+# Нагрузочный тест: настоящий dp из bot.py получает апдейты через long polling
+# от локального поддельного Bot API и отвечает ему же. Смоделированные
+# пользователи проходят сценарии покупки и пополнения, после прогона
+# выводятся пропускная способность, перцентили времени обработчиков и время
+# в базе по шагам сценариев.
+#
+#   python benchmark.py --users 2000 --concurrency 200
+#   python benchmark.py --json result.json
+#   python benchmark.py --baseline result.json  # код 1 при регрессии p95
+#
+# База и файлы товаров создаются во временной папке, shop.db не трогается.
+
+PURCHASE = "purchase"
+DEPOSIT = "deposit"
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+# Поддельный Bot API: отдаёт апдейты через getUpdates, на отправку сообщений
+# отвечает правдоподобными объектами и запоминает последнюю клавиатуру чата
+class FakeTelegram:
+    def __init__(self):
+        self.updates = asyncio.Queue()
+        self.keyboards = {}  # chat_id -> последняя inline-клавиатура
+        self.calls = {}  # метод -> число вызовов
+        self._message_ids = itertools.count(1)
+        self._update_ids = itertools.count(1)
+        self._runner = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def push(self, update):
+        update["update_id"] = next(self._update_ids)
+        self.updates.put_nowait(update)
+        return update["update_id"]
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            data = await request.json()
+        else:
+            data = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(float(data.get("timeout") or 0)))
+        if method == "getMe":
+            return self._ok({"id": 1, "is_bot": True, "first_name": "Shop", "username": "shop_bot"})
+        if method in ("sendMessage", "editMessageText", "sendDocument", "sendInvoice"):
+            chat_id = int(data.get("chat_id", 0))
+            markup = data.get("reply_markup")
+            if markup:
+                markup = json.loads(markup) if isinstance(markup, str) else markup
+                if "inline_keyboard" in markup:
+                    self.keyboards[chat_id] = markup["inline_keyboard"]
+            message = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": data.get("text", "")
+            }
+            if method == "sendDocument":
+                message["document"] = {"file_id": "bench_file", "file_unique_id": "bench_file"}
+            return self._ok(message)
+        return self._ok(True)
+
+    async def _get_updates(self, timeout):
+        result = []
+        try:
+            result.append(await asyncio.wait_for(self.updates.get(), timeout))
+        except asyncio.TimeoutError:
+            return result
+        while not self.updates.empty() and len(result) < 100:
+            result.append(self.updates.get_nowait())
+        return result
+
+    @staticmethod
+    def _ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+
+class Stats:
+    def __init__(self):
+        self.latency = {}  # (сценарий, шаг) -> [секунды]
+        self.db_time = {}
+        self.flows = {}  # сценарий -> завершённых прохождений
+        self.errors = 0
+
+
+# Смоделированный пользователь Telegram
+class User:
+    def __init__(self, bench, user_id):
+        self.bench = bench
+        self.user_id = user_id
+        self.message_id = 1
+
+    def _from(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}"}
+
+    def _chat(self):
+        return {"id": self.user_id, "type": "private"}
+
+    async def message(self, scenario, step, text=None, **extra):
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": self._chat(),
+            "from": self._from(),
+            **extra
+        }
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        await self.bench.send({"message": message}, scenario, step)
+
+    async def callback(self, scenario, step, data):
+        query = {
+            "id": str(random.getrandbits(63)),
+            "from": self._from(),
+            "chat_instance": str(self.user_id),
+            "data": data,
+            "message": {
+                "message_id": self.message_id,
+                "date": int(time.time()),
+                "chat": self._chat(),
+                "from": {"id": 1, "is_bot": True, "first_name": "Shop"},
+                "text": "..."
+            }
+        }
+        await self.bench.send({"callback_query": query}, scenario, step)
+
+    def button(self, prefix):
+        for row in self.bench.telegram.keyboards.get(self.user_id, []):
+            for button in row:
+                data = button.get("callback_data") or ""
+                if data.startswith(prefix):
+                    return data
+        return None
+
+    async def purchase(self, product_ids):
+        await self.message(PURCHASE, "start", "/start")
+        await self.message(PURCHASE, "catalog", "🛍 Каталог товаров")
+        product_id = random.choice(product_ids)
+        await self.callback(PURCHASE, "view", f"view_{product_id}")
+        await self.callback(PURCHASE, "buy", f"buy_{product_id}")
+        confirm = self.button(f"confirm_{product_id}_")
+        if confirm is None:
+            raise RuntimeError(f"пользователь {self.user_id} не получил кнопку подтверждения")
+        await self.callback(PURCHASE, "confirm", confirm)
+
+    async def deposit(self):
+        amount = random.randint(10, 500)
+        payload = f"stars_deposit_{self.user_id}_{amount}"
+        await self.message(DEPOSIT, "start", "/start")
+        await self.message(DEPOSIT, "profile", "👤 Личный кабинет")
+        await self.callback(DEPOSIT, "deposit_stars", "deposit_stars")
+        await self.message(DEPOSIT, "amount", str(amount))
+        await self.bench.send({"pre_checkout_query": {
+            "id": str(random.getrandbits(63)),
+            "from": self._from(),
+            "currency": "XTR",
+            "total_amount": amount,
+            "invoice_payload": payload
+        }}, DEPOSIT, "pre_checkout")
+        await self.message(DEPOSIT, "payment", successful_payment={
+            "currency": "XTR",
+            "total_amount": amount,
+            "invoice_payload": payload,
+            "telegram_payment_charge_id": f"charge{self.user_id}",
+            "provider_payment_charge_id": ""
+        })
+
+
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegram()
+        self.stats = Stats()
+        self.pending = {}  # update_id -> (future, сценарий, шаг)
+        self.db_timer = contextvars.ContextVar("db_timer", default=None)
+
+    async def send(self, update, scenario, step):
+        future = asyncio.get_running_loop().create_future()
+        update_id = self.telegram.push(update)
+        self.pending[update_id] = (future, scenario, step)
+        await future
+
+    # Внешний middleware: время обработки апдейта и время в базе
+    async def measure(self, handler, event, data):
+        spent = [0.0]
+        self.db_timer.set(spent)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            elapsed = time.perf_counter() - started
+            future, scenario, step = self.pending.pop(event.update_id, (None, None, None))
+            if future is not None:
+                key = (scenario, step)
+                self.stats.latency.setdefault(key, []).append(elapsed)
+                self.stats.db_time.setdefault(key, []).append(spent[0])
+                future.set_result(None)
+
+    # Время обращений к базе (включая ожидание в очереди пула) в рамках апдейта
+    def instrument_db(self, config):
+        def timed(func):
+            async def wrapper(*args):
+                started = time.perf_counter()
+                try:
+                    return await func(*args)
+                finally:
+                    spent = self.db_timer.get()
+                    if spent is not None:
+                        spent[0] += time.perf_counter() - started
+            return wrapper
+
+        config.run_db = timed(config.run_db)
+        config.run_read = timed(config.run_read)
+
+    async def run_user(self, semaphore, user_id, product_ids):
+        async with semaphore:
+            user = User(self, user_id)
+            scenario = DEPOSIT if random.random() < self.args.deposit_share else PURCHASE
+            try:
+                if scenario == PURCHASE:
+                    await self.shop_config.add_stars(user_id, 10 ** 6)
+                    await user.purchase(product_ids)
+                else:
+                    await user.deposit()
+                self.stats.flows[scenario] = self.stats.flows.get(scenario, 0) + 1
+            except Exception as e:
+                self.stats.errors += 1
+                print(f"Ошибка сценария {scenario}: {e}", file=sys.stderr)
+
+    async def run(self):
+        from aiogram.client.telegram import TelegramAPIServer
+
+        base_url = await self.telegram.start()
+        import config as shop_config
+        # bot.py создаёт Bot при импорте, а токен в config.py по умолчанию
+        # пустой. Запросы идут в имитацию Telegram, настоящий токен не нужен.
+        shop_config.TOKEN = "123456:BENCH"
+        import bot as shop
+        self.shop_config = shop_config
+        # Журнал каждого апдейта искажает замеры
+        logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+        self.instrument_db(shop_config)
+        shop.bot.session.api = TelegramAPIServer.from_base(base_url)
+        shop.dp.update.outer_middleware(self.measure)
+
+        product_ids = []
+        for i in range(self.args.products):
+            product_ids.append(await shop_config.add_product(
+                f"Товар {i + 1}", random.randint(10, 300), "Описание товара",
+                "products_files/bench", f"bench_file_{i + 1}"
+            ))
+        await shop.sync_catalog(force=True)
+
+        shop.outbox.start()
+        polling = asyncio.create_task(shop.dp.start_polling(shop.bot, handle_signals=False))
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        first_user = 10 ** 9
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(
+                self.run_user(semaphore, first_user + i, product_ids)
+                for i in range(self.args.users)
+            ))
+            elapsed = time.perf_counter() - started
+        finally:
+            await shop.dp.stop_polling()
+            await polling
+            backlog = shop.outbox.qsize()
+            await shop.outbox.stop()
+            await shop.bot.session.close()
+            await self.telegram.stop()
+        return elapsed, backlog
+
+    def report(self, elapsed, backlog):
+        result = {"elapsed": elapsed, "errors": self.stats.errors, "outbox_backlog": backlog, "steps": {}}
+        updates = sum(len(v) for v in self.stats.latency.values())
+        print(f"Пользователей: {self.args.users}, параллельно: {self.args.concurrency}, товаров: {self.args.products}")
+        print(f"Время: {elapsed:.2f} с, апдейтов: {updates} ({updates / elapsed:.1f}/с), ошибок: {self.stats.errors}")
+        for scenario, count in sorted(self.stats.flows.items()):
+            print(f"Сценарий {scenario}: {count} прохождений ({count / elapsed:.1f}/с)")
+        print(f"Осталось в очереди сообщений: {backlog}")
+        print()
+        print(f"{'шаг':<28}{'n':>7}{'p50 мс':>10}{'p95 мс':>10}{'p99 мс':>10}{'БД p50':>10}{'БД p95':>10}")
+        for (scenario, step), values in sorted(self.stats.latency.items()):
+            db = self.stats.db_time[(scenario, step)]
+            row = {
+                "count": len(values),
+                "p50": percentile(values, 50) * 1000,
+                "p95": percentile(values, 95) * 1000,
+                "p99": percentile(values, 99) * 1000,
+                "db_p50": percentile(db, 50) * 1000,
+                "db_p95": percentile(db, 95) * 1000,
+                "db_mean": statistics.fmean(db) * 1000
+            }
+            name = f"{scenario}/{step}"
+            result["steps"][name] = row
+            print(f"{name:<28}{row['count']:>7}{row['p50']:>10.2f}{row['p95']:>10.2f}{row['p99']:>10.2f}"
+                  f"{row['db_p50']:>10.2f}{row['db_p95']:>10.2f}")
+        return result
+
+
+# Шаги, у которых p95 вырос больше допустимого относительно базового прогона
+def find_regressions(result, baseline, tolerance):
+    regressions = []
+    for name, row in result["steps"].items():
+        base = baseline.get("steps", {}).get(name)
+        if base and row["p95"] > base["p95"] * (1 + tolerance):
+            regressions.append((name, base["p95"], row["p95"]))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на поддельном Bot API")
+    parser.add_argument("--users", type=int, default=1000, help="число смоделированных пользователей")
+    parser.add_argument("--concurrency", type=int, default=100, help="сколько пользователей действуют одновременно")
+    parser.add_argument("--products", type=int, default=50, help="товаров в каталоге")
+    parser.add_argument("--deposit-share", type=float, default=0.3, help="доля пользователей в сценарии пополнения")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="сохранить результат в файл")
+    parser.add_argument("--baseline", help="сравнить с сохранённым результатом")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимый рост p95 относительно базового прогона")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    for name in ("json", "baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    # bot.py и config.py создают shop.db и products_files в текущей папке
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(tempfile.mkdtemp(prefix="shop_bench_"))
+
+    bench = Benchmark(args)
+    elapsed, backlog = asyncio.run(bench.run())
+    result = bench.report(elapsed, backlog)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = find_regressions(result, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print(f"Регрессия {name}: p95 {before:.2f} -> {after:.2f} мс")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,61 @@
 import os
+import html
 import logging
 import asyncio
+import secrets
+from aiohttp import web
 from aiogram import Bot, types, F
 from aiogram.enums import ParseMode
-from aiogram.filters import Command
+from aiogram.exceptions import TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.filters import Command, CommandObject, StateFilter
 from aiogram.types import (
     LabeledPrice, 
     FSInputFile, 
+    BufferedInputFile,
     InlineKeyboardButton, 
     InlineKeyboardMarkup,
     ReplyKeyboardMarkup,
     KeyboardButton,
     ReplyKeyboardRemove,
-    PreCheckoutQuery
+    PreCheckoutQuery,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InputTextMessageContent
 )
 from aiogram import Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 
 # Импорт конфигурации
 from config import (
-    TOKEN, SUPPORT_USERNAME, ADMIN_IDS, conn, cursor, 
-    products, get_stars_balance, get_purchases_count, 
-    get_stats, update_stats, get_notifications_enabled, 
-    set_notifications_enabled, load_products
+    TOKEN, SUPPORT_USERNAME, ADMIN_IDS, STATS_RECONCILE_INTERVAL,
+    USE_WEBHOOK, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT,
+    WORKERS, METRICS_PORT, BULK_NOTIFY_RATE, QUERY_PROFILER, PRODUCT_FILES_DIR, FILE_GC_INTERVAL, get_stars_balance, get_purchases_count, 
+    get_stats, reconcile_stats, prune_hourly_rollups, get_period_stats, get_product_sales,
+    get_notifications_enabled, 
+    set_notifications_enabled, add_user, check_query_plans,
+    add_stars, remove_stars, record_purchase, record_deposit,
+    add_product, get_product_file_path, update_product_field,
+    delete_product, get_purchase_history, get_deposit_history,
+    get_catalog_page, set_product_file, set_product_file_id,
+    PURCHASE_DUPLICATE, PURCHASE_INSUFFICIENT, FSM_STORAGE, FSM_STATE_TTL,
+    cleanup_fsm_states, cancel_broadcasts, get_broadcasts, search_products,
+    CATALOG_PAGE_SIZE, INLINE_PAGE_SIZE, INLINE_CACHE_TIME
 )
+from broadcast import Broadcaster
+from bulk_balance import apply_balance_csv
+from file_store import store_telegram_file, release_file, collect_garbage
+from fsm_storage import create_fsm_storage
+from history_export import export_history_csv
+from metrics import setup_metrics, start_metrics_server
+from outbox import Outbox
+from product_cache import ProductCache
+from query_profiler import QueryProfiler
+from sharding import run_supervisor
+from throttling import ThrottlingMiddleware
 
 # Настройка логирования
 logging.basicConfig(
@@ -36,7 +65,29 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+dp = Dispatcher(storage=create_fsm_storage())
+
+# Все исходящие bot.send_* идут через очередь с лимитами Telegram
+outbox = Outbox(bot)
+
+# Рассылки всем пользователям
+broadcaster = Broadcaster(bot, outbox)
+
+# Товары процесса, согласованные с базой по версии каталога
+product_cache = ProductCache()
+
+# Защита от флуда. Подключается раньше метрик: отброшенные запросы
+# не попадают во время обработчиков.
+throttling = ThrottlingMiddleware()
+for observer in (dp.message, dp.callback_query, dp.inline_query):
+    observer.middleware(throttling)
+
+setup_metrics(dp, bot, outbox)
+
+# Статистика SQL-запросов процесса
+query_profiler = QueryProfiler()
+if QUERY_PROFILER:
+    query_profiler.install()
 
 # Состояния для FSM
 class Form(StatesGroup):
@@ -49,12 +100,16 @@ class Form(StatesGroup):
     edit_product_value = State()
     delete_product_confirm = State()
     deposit_stars_amount = State()
+    bulk_stars_file = State()
+    broadcast_message = State()
+    search_query = State()
 
 # Главное меню
 def get_main_menu():
     builder = ReplyKeyboardBuilder()
     builder.add(
         KeyboardButton(text="🛍 Каталог товаров"),
+        KeyboardButton(text="🔎 Поиск"),
         KeyboardButton(text="👤 Личный кабинет"),
         KeyboardButton(text="🆘 Техподдержка")
     )
@@ -74,9 +129,10 @@ def get_admin_menu():
     return builder.as_markup(resize_keyboard=True)
 
 # Меню уведомлений
-def get_notifications_menu(user_id):
-    enabled_purchase = get_notifications_enabled(user_id) & 1  # Покупки
-    enabled_deposit = (get_notifications_enabled(user_id) >> 1) & 1  # Пополнения
+async def get_notifications_menu(user_id):
+    enabled = await get_notifications_enabled(user_id)
+    enabled_purchase = enabled & 1  # Покупки
+    enabled_deposit = (enabled >> 1) & 1  # Пополнения
     builder = InlineKeyboardBuilder()
     builder.add(
         InlineKeyboardButton(
@@ -104,20 +160,99 @@ def get_products_menu():
     builder.adjust(1)
     return builder.as_markup()
 
+# Варианты списка товаров: префикс callback_data кнопки товара и заголовок
+CATALOG_VARIANTS = {
+    "shop": ("view_", "📚 Каталог товаров:"),
+    "edit": ("edit_select_", "Выберите товар для редактирования:"),
+    "delete": ("delete_select_", "Выберите товар для удаления:"),
+}
+
+# Кэш клавиатур каталога. Каждая страница каждого варианта строится один раз
+# и сбрасывается только при изменении товаров. Кэшируются только первая
+# страница и страницы, на которые ведут кнопки уже построенных страниц:
+# anchor приходит из callback_data, и произвольные значения не должны
+# раздувать кэш. Поколение увеличивается при сбросе: страница, построенная
+# по данным до сброса, в кэш не попадает.
+_catalog_markup_cache = {}
+_catalog_page_keys = set()
+_catalog_generation = 0
+
+# Возвращает клавиатуру страницы каталога или None, если товаров нет
+async def get_catalog_markup(variant, anchor=0, forward=True):
+    key = (variant, anchor, forward)
+    if key in _catalog_markup_cache:
+        return _catalog_markup_cache[key]
+    
+    generation = _catalog_generation
+    rows, has_prev, has_next = await get_catalog_page(anchor, forward)
+    cacheable = generation == _catalog_generation
+    markup = None
+    if rows:
+        callback_prefix = CATALOG_VARIANTS[variant][0]
+        builder = InlineKeyboardBuilder()
+        for id, name, stars_price in rows:
+            builder.row(InlineKeyboardButton(
+                text=f"{name} - {stars_price}⭐", 
+                callback_data=f"{callback_prefix}{id}"
+            ))
+        nav = []
+        if has_prev:
+            nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"page_{variant}_p_{rows[0][0]}"))
+            if cacheable:
+                _catalog_page_keys.add((variant, rows[0][0], False))
+        if has_next:
+            nav.append(InlineKeyboardButton(text="➡️", callback_data=f"page_{variant}_n_{rows[-1][0]}"))
+            if cacheable:
+                _catalog_page_keys.add((variant, rows[-1][0], True))
+        if nav:
+            builder.row(*nav)
+        markup = builder.as_markup()
+    if cacheable and ((anchor == 0 and forward) or key in _catalog_page_keys):
+        _catalog_markup_cache[key] = markup
+    return markup
+
+def invalidate_catalog_cache():
+    global _catalog_generation
+    _catalog_generation += 1
+    _catalog_markup_cache.clear()
+    _catalog_page_keys.clear()
+
+# Синхронизация каталога между процессами: кэш товаров дочитывает изменения,
+# а готовые клавиатуры сбрасываются, если каталог изменился.
+# force - проверить сразу, например после изменения товара в этом процессе
+async def sync_catalog(force=False):
+    if await product_cache.refresh(force):
+        invalidate_catalog_cache()
+
+@dp.update.outer_middleware()
+async def catalog_sync_middleware(handler, event, data):
+    try:
+        await sync_catalog()
+    except Exception as e:
+        logger.error(f"Ошибка синхронизации каталога: {e}")
+    return await handler(event, data)
+
 # Команда /start
-@dp.message(Command("start"))
-async def start(message: types.Message):
+@dp.message(Command("start"), flags={"throttling": "start"})
+async def start(message: types.Message, command: CommandObject):
     user_id = message.from_user.id
     
-    cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    update_stats()  # Обновляем статистику при первом входе
+    await add_user(user_id)
+    
+    # Ссылка из инлайн-режима: t.me/<бот>?start=view_<id>
+    if command.args and command.args.startswith("view_"):
+        product_id = int(command.args[5:]) if command.args[5:].isdigit() else 0
+        product = product_cache.get(product_id)
+        if product:
+            text, keyboard = get_product_card(product_id, product, await get_stars_balance(user_id))
+            await message.answer(text, reply_markup=keyboard)
+            return
     
     if user_id in ADMIN_IDS:
         await message.answer("👋 Добро пожаловать в админ-панель!", reply_markup=get_admin_menu())
         return
     
-    stars_balance = get_stars_balance(user_id)
+    stars_balance = await get_stars_balance(user_id)
     text = (
         "🛒 Добро пожаловать в магазин цифровых товаров!\n"
         f"⭐ Ваши звезды: {stars_balance}\n\n"
@@ -152,16 +287,15 @@ async def give_stars(message: types.Message):
             await message.answer("❌ User ID должен быть целым числом. Используйте /givestars <user_id> количество.")
             return
         
-        cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-        cursor.execute("UPDATE users SET stars_balance = stars_balance + ? WHERE user_id=?", (amount, user_id))
-        conn.commit()
+        new_balance = await add_stars(user_id, amount)
         
-        await bot.send_message(
-            chat_id=user_id,
-            text=f"🎁 Вам начислено {amount} ⭐ в подарок! Новый баланс: {get_stars_balance(user_id)}"
+        await outbox.enqueue(
+            "send_message",
+            user_id,
+            text=f"🎁 Вам начислено {amount} ⭐ в подарок! Новый баланс: {new_balance}"
         )
         
-        await message.answer(f"✅ Пользователю с ID {user_id} выдано {amount} звезд. Новый баланс: {get_stars_balance(user_id)}")
+        await message.answer(f"✅ Пользователю с ID {user_id} выдано {amount} звезд. Новый баланс: {new_balance}")
     except ValueError:
         await message.answer("❌ Неверный формат количества. Введите целое число.")
     except Exception as e:
@@ -194,21 +328,146 @@ async def delete_stars(message: types.Message):
             await message.answer("❌ User ID должен быть целым числом. Используйте /starsdelete <user_id> количество.")
             return
         
-        current_balance = get_stars_balance(user_id)
-        if current_balance < amount:
+        if not await remove_stars(user_id, amount):
+            current_balance = await get_stars_balance(user_id)
             await message.answer(f"❌ Недостаточно звезд у пользователя. Текущий баланс: {current_balance}")
             return
         
-        cursor.execute("UPDATE users SET stars_balance = stars_balance - ? WHERE user_id=?", (amount, user_id))
-        conn.commit()
-        
-        await message.answer(f"✅ У пользователя с ID {user_id} списано {amount} звезд. Новый баланс: {get_stars_balance(user_id)}")
+        await message.answer(f"✅ У пользователя с ID {user_id} списано {amount} звезд. Новый баланс: {await get_stars_balance(user_id)}")
     except ValueError:
         await message.answer("❌ Неверный формат количества. Введите целое число.")
     except Exception as e:
         logger.error(f"Ошибка при списании звезд: {e}")
         await message.answer("⚠️ Произошла ошибка. Проверьте формат команды или обратитесь в поддержку.")
 
+# Массовое начисление и списание звезд из CSV-файла
+@dp.message(Command("bulkstars"))
+async def bulk_stars_start(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    await message.answer(
+        "Отправьте CSV-файл (UTF-8) со строками <code>user_id,amount</code>.\n"
+        "Положительное amount начисляет звезды, отрицательное списывает.\n"
+        "Пользователи получат уведомления о начислении."
+    )
+    await state.set_state(Form.bulk_stars_file)
+
+@dp.message(Form.bulk_stars_file)
+async def bulk_stars_file(message: types.Message, state: FSMContext):
+    await state.clear()
+    if not message.document:
+        await message.answer("❌ Нужен CSV-файл. Начните заново: /bulkstars", reply_markup=get_admin_menu())
+        return
+    
+    await message.answer("⏳ Обработка файла...")
+    notify_at = None
+    
+    async def notify(applied):
+        nonlocal notify_at
+        notify_at = await outbox.enqueue_many(
+            "send_message",
+            [
+                (user_id, {"text": f"🎁 Вам начислено {amount} ⭐ в подарок! Новый баланс: {balance}"})
+                for user_id, amount, balance in applied if amount > 0
+            ],
+            rate=BULK_NOTIFY_RATE,
+            start=notify_at
+        )
+    
+    try:
+        result = await apply_balance_csv(bot, message.document.file_id, notify)
+    except UnicodeDecodeError:
+        await message.answer("❌ Файл должен быть в кодировке UTF-8.", reply_markup=get_admin_menu())
+        return
+    except Exception as e:
+        logger.error(f"Ошибка массового изменения балансов: {e}")
+        await message.answer("⚠️ Ошибка обработки файла. Часть строк могла быть применена.", reply_markup=get_admin_menu())
+        return
+    
+    await message.answer(
+        f"✅ Применено строк: {result.applied}\n"
+        f"⭐ Начислено: {result.credited}\n"
+        f"➖ Списано: {result.debited}\n"
+        f"❌ Ошибок: {len(result.failures)}",
+        reply_markup=get_admin_menu()
+    )
+    if result.failures:
+        await message.answer_document(
+            BufferedInputFile(result.failures_csv(), filename="bulkstars_errors.csv"),
+            caption="Строки, которые не удалось применить"
+        )
+
+# Рассылка: админ присылает сообщение, бот копирует его всем пользователям
+@dp.message(Command("broadcast"))
+async def broadcast_start(message: types.Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    await message.answer("Отправьте сообщение для рассылки (текст, фото, документ и т.д.):")
+    await state.set_state(Form.broadcast_message)
+
+@dp.message(Form.broadcast_message)
+async def broadcast_message(message: types.Message, state: FSMContext):
+    await state.clear()
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="✅ Отправить всем", callback_data=f"broadcast_confirm_{message.message_id}")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="broadcast_cancel")]
+    ])
+    await message.answer("Отправить это сообщение всем пользователям?", reply_markup=keyboard)
+
+@dp.callback_query(F.data.startswith("broadcast_confirm_"))
+async def broadcast_confirm(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔ У вас нет доступа.")
+        return
+    
+    message_id = int(callback.data.split("_")[2])
+    broadcast_id = await broadcaster.start_broadcast(callback.from_user.id, callback.message.chat.id, message_id)
+    await callback.message.edit_text(
+        f"📣 Рассылка #{broadcast_id} запущена. Прогресс: /broadcaststatus, остановить: /broadcaststop"
+    )
+    await callback.answer()
+
+@dp.callback_query(F.data == "broadcast_cancel")
+async def broadcast_cancel(callback: types.CallbackQuery):
+    await callback.message.edit_text("❌ Рассылка отменена.")
+    await callback.answer()
+
+BROADCAST_STATUSES = {"running": "⏳ идёт", "done": "✅ завершена", "cancelled": "⛔ остановлена"}
+
+@dp.message(Command("broadcaststatus"))
+async def broadcast_status(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    broadcasts = await get_broadcasts(5)
+    if not broadcasts:
+        await message.answer("📭 Рассылок ещё не было.")
+        return
+    
+    text = "📣 Последние рассылки:\n\n"
+    for broadcast_id, status, sent, failed, blocked, created_at in broadcasts:
+        text += (
+            f"#{broadcast_id} от {created_at}: {BROADCAST_STATUSES.get(status, status)}\n"
+            f"   ✅ {sent}  🚫 {blocked}  ❌ {failed}\n"
+        )
+    await message.answer(text)
+
+@dp.message(Command("broadcaststop"))
+async def broadcast_stop(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    if await cancel_broadcasts():
+        await message.answer("⛔ Рассылка будет остановлена после текущей пачки.")
+    else:
+        await message.answer("Нет идущих рассылок.")
+
 # Админ панель
 @dp.message(F.text == "📦 Управление товарами")
 async def manage_products(message: types.Message):
@@ -225,15 +484,102 @@ async def show_stats(message: types.Message):
         await message.answer("⛔ У вас нет доступа к этой команде.")
         return
     
-    update_stats()
-    total_purchases, total_stars_deposited, total_users = get_stats()
+    total_purchases, total_stars_deposited, total_users = await get_stats()
     text = (
         "📊 Статистика:\n"
         f"🛍 Количество покупок: {total_purchases}\n"
         f"⭐ Всего пополнено звёзд: {total_stars_deposited}\n"
-        f"👥 Количество пользователей: {total_users}"
+        f"👥 Количество пользователей: {total_users}\n\n"
+        + format_period_stats("Сегодня", await get_period_stats(0))
     )
-    await message.answer(text, reply_markup=get_admin_menu())
+    await message.answer(text, reply_markup=get_stats_keyboard())
+
+STATS_PERIODS = {0: "Сегодня", 7: "За 7 дней", 30: "За 30 дней"}
+
+def get_stats_keyboard():
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=title, callback_data=f"stats_{days}") for days, title in STATS_PERIODS.items()],
+        [InlineKeyboardButton(text="📦 По товарам (30 дней)", callback_data="stats_products")]
+    ])
+
+def format_period_stats(title, stats):
+    purchases, revenue, deposits, deposited, new_users = stats
+    return (
+        f"📅 {title}:\n"
+        f"🛍 Покупок: {purchases}\n"
+        f"💰 Выручка: {revenue}⭐\n"
+        f"💳 Пополнений: {deposits} на {deposited}⭐\n"
+        f"👥 Новых пользователей: {new_users}"
+    )
+
+# Статистика за период (по сводкам, без чтения purchases и deposits)
+@dp.callback_query(F.data.startswith("stats_"))
+async def stats_period(callback: types.CallbackQuery):
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    if callback.data == "stats_products":
+        sales = await get_product_sales(30)
+        if not sales:
+            text = "📦 За 30 дней продаж не было."
+        else:
+            lines = ["📦 Продажи по товарам за 30 дней:\n"]
+            for product_id, name, purchases, revenue in sales:
+                lines.append(f"• {name} (ID {product_id}): {purchases} шт., {revenue}⭐")
+            text = "\n".join(lines)
+    else:
+        days = int(callback.data.split("_")[1])
+        text = format_period_stats(STATS_PERIODS.get(days, f"За {days} дней"), await get_period_stats(days))
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=get_stats_keyboard())
+    except TelegramBadRequest:
+        pass  # Текст не изменился
+    await callback.answer()
+
+# Самые тяжёлые SQL-запросы: /slowqueries [количество] или /slowqueries reset
+@dp.message(Command("slowqueries"))
+async def slow_queries(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("⛔ У вас нет доступа к этой команде.")
+        return
+    
+    if not QUERY_PROFILER:
+        await message.answer("❌ Профилировщик запросов выключен (QUERY_PROFILER в config.py).")
+        return
+    
+    parts = message.text.split()
+    if len(parts) > 1 and parts[1] == "reset":
+        query_profiler.reset()
+        await message.answer("✅ Статистика запросов сброшена.")
+        return
+    
+    try:
+        limit = max(1, min(int(parts[1]), 20)) if len(parts) > 1 else 10
+    except ValueError:
+        await message.answer("❌ Использование: /slowqueries [количество] или /slowqueries reset")
+        return
+    
+    top = query_profiler.top(limit)
+    if not top:
+        await message.answer("📭 Запросов пока не было.")
+        return
+    
+    text = f"🐢 Запросы по суммарному времени (медленные - дольше {query_profiler.threshold * 1000:.0f} мс):\n\n"
+    for i, (query, count, total, average, longest, slow, plan) in enumerate(top, 1):
+        entry = (
+            f"{i}. <code>{html.escape(query[:300])}</code>\n"
+            f"   Выполнений: {count}, всего: {total * 1000:.1f} мс, "
+            f"среднее: {average * 1000:.2f} мс, максимум: {longest * 1000:.1f} мс, медленных: {slow}\n"
+        )
+        if plan:
+            entry += f"   План: {html.escape('; '.join(plan))[:300]}\n"
+        if len(text) + len(entry) > 4000:
+            break
+        text += entry + "\n"
+    
+    await message.answer(text)
 
 # Уведомления
 @dp.message(F.text == "📩 Уведомления")
@@ -242,20 +588,20 @@ async def manage_notifications(message: types.Message):
         await message.answer("⛔ У вас нет доступа к этой команде.")
         return
     
-    await message.answer("📩 Настройка уведомлений:", reply_markup=get_notifications_menu(message.from_user.id))
+    await message.answer("📩 Настройка уведомлений:", reply_markup=await get_notifications_menu(message.from_user.id))
 
 @dp.callback_query(F.data.in_(["toggle_purchase_notifications", "toggle_deposit_notifications"]))
 async def toggle_notifications(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    current_state = get_notifications_enabled(user_id)
+    current_state = await get_notifications_enabled(user_id)
     if callback.data == "toggle_purchase_notifications":
         new_state = current_state ^ 1  # Инверсия бита для покупок
     else:  # toggle_deposit_notifications
         new_state = current_state ^ 2  # Инверсия бита для пополнений
-    set_notifications_enabled(user_id, new_state)
+    await set_notifications_enabled(user_id, new_state)
     await callback.message.edit_text(
         "📩 Настройка уведомлений:",
-        reply_markup=get_notifications_menu(user_id)
+        reply_markup=await get_notifications_menu(user_id)
     )
     await callback.answer()
 
@@ -300,26 +646,11 @@ async def add_product_desc(message: types.Message, state: FSMContext):
 async def add_product_file(message: types.Message, state: FSMContext):
     data = await state.get_data()
     
-    if not os.path.exists("products_files"):
-        os.makedirs("products_files")
-    
     file_id = message.document.file_id
-    file = await bot.get_file(file_id)
-    file_path = f"products_files/{file_id}_{message.document.file_name}"
-    await bot.download_file(file.file_path, file_path)
+    file_path = await store_telegram_file(bot, file_id)
     
-    cursor.execute("SELECT MAX(id) FROM products")
-    max_id = cursor.fetchone()[0] or 0
-    new_id = max_id + 1
-    
-    cursor.execute(
-        "INSERT INTO products (id, name, stars_price, desc, file_path) VALUES (?, ?, ?, ?, ?)",
-        (new_id, data['name'], data['stars_price'], data['desc'], file_path)
-    )
-    conn.commit()
-    
-    global products
-    products = load_products()
+    await add_product(data['name'], data['stars_price'], data['desc'], file_path, file_id, message.document.file_name)
+    await sync_catalog(force=True)
     
     await message.answer(f"✅ Товар \"{data['name']}\" успешно добавлен!", reply_markup=get_admin_menu())
     await state.clear()
@@ -331,22 +662,15 @@ async def edit_product_start(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer("⛔ У вас нет доступа.")
         return
     
-    if not products:
+    markup = await get_catalog_markup("edit")
+    if markup is None:
         await callback.message.answer("❌ Нет товаров для редактирования.")
         await callback.answer()
         return
     
-    builder = InlineKeyboardBuilder()
-    for id, product in products.items():
-        builder.add(InlineKeyboardButton(
-            text=f"{product['name']} - {product['stars_price']}⭐", 
-            callback_data=f"edit_select_{id}"
-        ))
-    builder.adjust(1)
-    
     await callback.message.edit_text(
         "Выберите товар для редактирования:",
-        reply_markup=builder.as_markup()
+        reply_markup=markup
     )
     await callback.answer()
 
@@ -407,24 +731,14 @@ async def edit_product_value(message: types.Message, state: FSMContext):
             await message.answer("❌ Пожалуйста, отправьте файл.")
             return
             
-        cursor.execute("SELECT file_path FROM products WHERE id=?", (product_id,))
-        old_file_path = cursor.fetchone()[0]
-        
-        if os.path.exists(old_file_path):
-            try:
-                os.remove(old_file_path)
-            except Exception as e:
-                logger.error(f"Ошибка удаления файла: {e}")
+        old_file_path = await get_product_file_path(product_id)
         
         file_id = message.document.file_id
-        file = await bot.get_file(file_id)
-        new_file_path = f"products_files/{file_id}_{message.document.file_name}"
-        await bot.download_file(file.file_path, new_file_path)
+        new_file_path = await store_telegram_file(bot, file_id)
         
-        cursor.execute(
-            "UPDATE products SET file_path=? WHERE id=?",
-            (new_file_path, product_id)
-        )
+        await set_product_file(product_id, new_file_path, file_id, message.document.file_name)
+        if old_file_path != new_file_path:
+            release_file(old_file_path)
     else:
         if field == "stars_price":
             try:
@@ -438,14 +752,9 @@ async def edit_product_value(message: types.Message, state: FSMContext):
         else:
             value = message.text
         
-        cursor.execute(
-            f"UPDATE products SET {field}=? WHERE id=?",
-            (value, product_id)
-        )
+        await update_product_field(product_id, field, value)
     
-    conn.commit()
-    global products
-    products = load_products()
+    await sync_catalog(force=True)
     
     await message.answer("✅ Товар успешно обновлен!", reply_markup=get_admin_menu())
     await state.clear()
@@ -457,29 +766,25 @@ async def delete_product_start(callback: types.CallbackQuery, state: FSMContext)
         await callback.answer("⛔ У вас нет доступа.")
         return
     
-    if not products:
+    markup = await get_catalog_markup("delete")
+    if markup is None:
         await callback.message.answer("❌ Нет товаров для удаления.")
         await callback.answer()
         return
     
-    builder = InlineKeyboardBuilder()
-    for id, product in products.items():
-        builder.add(InlineKeyboardButton(
-            text=f"{product['name']} - {product['stars_price']}⭐", 
-            callback_data=f"delete_select_{id}"
-        ))
-    builder.adjust(1)
-    
     await callback.message.edit_text(
         "Выберите товар для удаления:",
-        reply_markup=builder.as_markup()
+        reply_markup=markup
     )
     await callback.answer()
 
 @dp.callback_query(F.data.startswith("delete_select_"))
 async def delete_product_select(callback: types.CallbackQuery, state: FSMContext):
     product_id = int(callback.data.split("_")[2])
-    product = products[product_id]
+    product = product_cache.get(product_id)
+    if not product:
+        await callback.answer("❌ Товар не найден!")
+        return
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"delete_confirm_{product_id}")],
@@ -496,19 +801,13 @@ async def delete_product_select(callback: types.CallbackQuery, state: FSMContext
 
 @dp.callback_query(F.data.startswith("delete_confirm_"))
 async def delete_product_confirm(callback: types.CallbackQuery):
-    global products
-    
     try:
         product_id = int(callback.data.split("_")[2])
-        product = products[product_id]
+        product = product_cache.products[product_id]
         
-        if os.path.exists(product['file_path']):
-            os.remove(product['file_path'])
-        
-        cursor.execute("DELETE FROM products WHERE id=?", (product_id,))
-        conn.commit()
-        
-        products = load_products()
+        await delete_product(product_id)
+        await sync_catalog(force=True)
+        release_file(product['file_path'])
         
         await callback.message.edit_text(
             f"✅ Товар \"{product['name']}\" успешно удален!",
@@ -523,68 +822,117 @@ async def delete_product_confirm(callback: types.CallbackQuery):
 @dp.message(F.text == "🛍 Каталог товаров")
 @dp.message(Command("shop"))
 async def shop(message: types.Message):
-    if not products:
+    markup = await get_catalog_markup("shop")
+    if markup is None:
         await message.answer("📭 В магазине пока нет товаров.")
         return
     
-    builder = InlineKeyboardBuilder()
-    for id, product in products.items():
-        builder.add(InlineKeyboardButton(
-            text=f"{product['name']} - {product['stars_price']}⭐", 
-            callback_data=f"view_{id}"
-        ))
-    builder.adjust(1)
-    
     await message.answer(
         "📚 Каталог товаров:",
-        reply_markup=builder.as_markup()
+        reply_markup=markup
     )
 
+# Листание страниц каталога
+@dp.callback_query(F.data.startswith("page_"))
+async def catalog_page(callback: types.CallbackQuery):
+    _, variant, direction, anchor = callback.data.split("_")
+    if variant not in CATALOG_VARIANTS:
+        await callback.answer()
+        return
+    if variant != "shop" and callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("⛔ У вас нет доступа.")
+        return
+    
+    markup = await get_catalog_markup(variant, int(anchor), direction == "n")
+    if markup is None:
+        await callback.message.edit_text("📭 В магазине пока нет товаров.")
+    else:
+        await callback.message.edit_text(CATALOG_VARIANTS[variant][1], reply_markup=markup)
+    await callback.answer()
+
 # Просмотр товара
 @dp.callback_query(F.data.startswith("view_"))
 async def view_product(callback: types.CallbackQuery):
     product_id = int(callback.data.split("_")[1])
-    product = products.get(product_id)
+    product = product_cache.get(product_id)
     user_id = callback.from_user.id
     
     if not product:
         await callback.answer("❌ Товар не найден!")
         return
     
-    stars_balance = get_stars_balance(user_id)
-    
+    text, keyboard = get_product_card(product_id, product, await get_stars_balance(user_id))
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+# Карточка товара с кнопкой покупки
+def get_product_card(product_id, product, stars_balance):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="⭐ Купить", callback_data=f"buy_{product_id}")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_shop")]
     ])
-    
-    await callback.message.edit_text(
+    text = (
         f"<b>{product['name']}</b>\n\n"
         f"{product['desc']}\n\n"
         f"⭐ Цена: <b>{product['stars_price']}</b>\n"
         f"🆔 ID товара: <code>{product_id}</code>\n\n"
-        f"Ваши звезды: {stars_balance}",
-        reply_markup=keyboard
+        f"Ваши звезды: {stars_balance}"
+    )
+    return text, keyboard
+
+# Инлайн-режим (@бот запрос): товары из кэша процесса. Ответ одинаков для
+# всех пользователей, поэтому Telegram кэширует его на своей стороне
+# (is_personal=False) и повторные запросы до бота не доходят.
+@dp.inline_query(flags={"throttling": "search"})
+async def inline_catalog(inline_query: InlineQuery):
+    offset = int(inline_query.offset) if inline_query.offset.isdigit() else 0
+    product_ids = product_cache.search(inline_query.query)
+    page = product_ids[offset:offset + INLINE_PAGE_SIZE]
+    username = (await bot.me()).username
+    
+    results = []
+    for product_id in page:
+        product = product_cache.get(product_id)
+        results.append(InlineQueryResultArticle(
+            id=str(product_id),
+            title=f"{product['name']} - {product['stars_price']}⭐",
+            description=(product['desc'] or "")[:100],
+            input_message_content=InputTextMessageContent(
+                message_text=f"<b>{product['name']}</b>\n\n{product['desc']}\n\n⭐ Цена: <b>{product['stars_price']}</b>"
+            ),
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="🛍 Открыть в магазине", url=f"https://t.me/{username}?start=view_{product_id}")]
+            ])
+        ))
+    
+    next_offset = offset + len(page)
+    await inline_query.answer(
+        results,
+        cache_time=INLINE_CACHE_TIME,
+        is_personal=False,
+        next_offset=str(next_offset) if next_offset < len(product_ids) else ""
     )
-    await callback.answer()
 
 # Покупка товара
-@dp.callback_query(F.data.startswith("buy_"))
+@dp.callback_query(F.data.startswith("buy_"), flags={"throttling": "buy"})
 async def buy_product(callback: types.CallbackQuery):
     product_id = int(callback.data.split("_")[1])
-    product = products.get(product_id)
+    product = product_cache.get(product_id)
     user_id = callback.from_user.id
     
     if not product:
         await callback.answer("❌ Товар не найден!")
         return
         
-    stars_balance = get_stars_balance(user_id)
+    stars_balance = await get_stars_balance(user_id)
     stars_price = product['stars_price']
     
     if stars_balance >= stars_price:
+        # Одноразовый ключ подтверждения: повторное нажатие той же кнопки
+        # не приведёт ко второму списанию
+        nonce = secrets.token_hex(8)
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_{product_id}")],
+            [InlineKeyboardButton(text="✅ Подтвердить", callback_data=f"confirm_{product_id}_{nonce}")],
             [InlineKeyboardButton(text="❌ Отменить", callback_data=f"view_{product_id}")]
         ])
         
@@ -603,11 +951,55 @@ async def buy_product(callback: types.CallbackQuery):
             show_alert=True
         )
 
+# Отправка файла товара. Сначала по сохранённому file_id, без повторной
+# загрузки; если Telegram его отклонил - загрузка с диска и обновление file_id
+async def send_product_document(user_id, product_id, product, caption):
+    sent = None
+    if product.get('file_id'):
+        try:
+            sent = await bot.send_document(chat_id=user_id, document=product['file_id'], caption=caption)
+        except TelegramBadRequest as e:
+            logger.warning(f"Telegram отклонил file_id товара {product_id}: {e}")
+    
+    if sent is None:
+        sent = await bot.send_document(
+            chat_id=user_id,
+            document=FSInputFile(product['file_path'], filename=product.get('file_name')),
+            caption=caption
+        )
+    
+    if sent.document and sent.document.file_id != product.get('file_id'):
+        product['file_id'] = sent.document.file_id
+        await set_product_file_id(product_id, sent.document.file_id)
+    return sent
+
+# Доставка купленного товара из очереди. Временные ошибки передаются очереди
+# для повтора, при остальных покупатель получает сообщение об ошибке.
+@outbox.handler("product_document")
+async def deliver_product(user_id, product_id, caption, fallback_text, balance=None):
+    if balance is not None:
+        caption += f"\n⭐ Остаток: {balance}"
+    try:
+        product = product_cache.get(product_id)
+        if not product:
+            # Товар мог появиться в другом процессе после последней синхронизации
+            await sync_catalog(force=True)
+            product = product_cache.get(product_id)
+        if not product:
+            raise LookupError(f"товар {product_id} не найден")
+        await send_product_document(user_id, product_id, product, caption)
+    except (TelegramRetryAfter, TelegramNetworkError, TelegramServerError):
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка отправки файла: {e}")
+        await outbox.enqueue("send_message", user_id, text=fallback_text)
+
 # Подтверждение покупки
-@dp.callback_query(F.data.startswith("confirm_"))
+@dp.callback_query(F.data.startswith("confirm_"), flags={"throttling": "buy"})
 async def confirm_purchase(callback: types.CallbackQuery):
-    product_id = int(callback.data.split("_")[1])
-    product = products.get(product_id)
+    parts = callback.data.split("_")
+    product_id = int(parts[1])
+    product = product_cache.get(product_id)
     user_id = callback.from_user.id
     
     if not product:
@@ -615,22 +1007,38 @@ async def confirm_purchase(callback: types.CallbackQuery):
         return
         
     stars_price = product['stars_price']
-    
-    cursor.execute("UPDATE users SET stars_balance = stars_balance - ? WHERE user_id=?", 
-                  (stars_price, user_id))
-    cursor.execute("INSERT INTO purchases (user_id, product_id) VALUES (?, ?)", 
-                  (user_id, product_id))
-    conn.commit()
-    update_stats()  # Обновляем статистику
+    nonce = parts[2] if len(parts) > 2 else callback.id
+    
+    # Выдача товара ставится в outbox в одной транзакции со списанием
+    delivery = ("product_document", {
+        "product_id": product_id,
+        "caption": f"✅ Спасибо за покупку! Товар <b>{product['name']}</b> активирован.",
+        "fallback_text": (
+            f"✅ Покупка <b>{product['name']}</b> за {stars_price}⭐ завершена!\n"
+            f"⚠️ Ошибка отправки файла. Обратитесь в поддержку."
+        ),
+    })
+    result = await record_purchase(user_id, product_id, stars_price, f"{user_id}:{nonce}", delivery)
+    if result == PURCHASE_DUPLICATE:
+        await callback.answer("✅ Эта покупка уже обработана.")
+        return
+    if result == PURCHASE_INSUFFICIENT:
+        await callback.answer(
+            f"❌ Недостаточно звезд. Нужно {stars_price}", 
+            show_alert=True
+        )
+        return
+    outbox.wake()
     
     # Уведомление админу с обработкой ошибок
     try:
-        if get_notifications_enabled(ADMIN_IDS[0]):
+        if await get_notifications_enabled(ADMIN_IDS[0]):
             username = callback.from_user.username or str(user_id)
-            new_balance = get_stars_balance(user_id)
-            await bot.send_message(
+            new_balance = await get_stars_balance(user_id)
+            await outbox.enqueue(
+                "send_message",
                 ADMIN_IDS[0],
-                f"🔔 Новая покупка\n"
+                text=f"🔔 Новая покупка\n"
                 f"🆔 ID: {user_id}\n"
                 f"@{username} оплатил товар {product['name']}\n"
                 f"💰 Сумма покупки: {stars_price} звезд\n"
@@ -639,26 +1047,6 @@ async def confirm_purchase(callback: types.CallbackQuery):
     except Exception as e:
         logger.error(f"Ошибка отправки уведомления админу: {e}")
     
-    try:
-        file = FSInputFile(product['file_path'])
-        await bot.send_document(
-            chat_id=user_id,
-            document=file,
-            caption=(
-                f"✅ Спасибо за покупку! Товар <b>{product['name']}</b> активирован.\n"
-                f"⭐ Остаток: {get_stars_balance(user_id)}"
-            )
-        )
-    except Exception as e:
-        logger.error(f"Ошибка отправки файла: {e}")
-        await bot.send_message(
-            chat_id=user_id,
-            text=(
-                f"✅ Покупка <b>{product['name']}</b> за {stars_price}⭐ завершена!\n"
-                f"⚠️ Ошибка отправки файла. Обратитесь в поддержку."
-            )
-        )
-    
     await callback.message.edit_text(
         f"✅ Покупка <b>{product['name']}</b> за {stars_price}⭐ завершена!",
         reply_markup=InlineKeyboardMarkup(
@@ -672,21 +1060,14 @@ async def confirm_purchase(callback: types.CallbackQuery):
 # Возврат в каталог
 @dp.callback_query(F.data == "back_to_shop")
 async def back_to_shop(callback: types.CallbackQuery):
-    if not products:
+    markup = await get_catalog_markup("shop")
+    if markup is None:
         await callback.message.edit_text("📭 В магазине пока нет товаров.")
         return
     
-    builder = InlineKeyboardBuilder()
-    for id, product in products.items():
-        builder.add(InlineKeyboardButton(
-            text=f"{product['name']} - {product['stars_price']}⭐", 
-            callback_data=f"view_{id}"
-        ))
-    builder.adjust(1)
-    
     await callback.message.edit_text(
         "📚 Каталог товаров:",
-        reply_markup=builder.as_markup()
+        reply_markup=markup
     )
     await callback.answer()
 
@@ -694,8 +1075,8 @@ async def back_to_shop(callback: types.CallbackQuery):
 @dp.message(F.text == "👤 Личный кабинет")
 async def profile(message: types.Message):
     user_id = message.from_user.id
-    stars_balance = get_stars_balance(user_id)
-    purchases = get_purchases_count(user_id)
+    stars_balance = await get_stars_balance(user_id)
+    purchases = await get_purchases_count(user_id)
     
     text = (
         "👤 Личный кабинет\n"
@@ -732,12 +1113,13 @@ async def process_deposit_amount(message: types.Message, state: FSMContext):
             await message.answer("❌ Минимальная сумма пополнения - 10 звезд")
             return
             
-        await create_stars_invoice(message.from_user.id, amount, "Пополнение звездами")
+        await outbox.enqueue("stars_invoice", message.from_user.id, amount=amount, description="Пополнение звездами")
         await state.clear()
         await message.answer("Ожидайте инвойс для оплаты...", reply_markup=get_main_menu())
     except ValueError:
         await message.answer("❌ Неверный формат. Введите целое число, например: 50")
 
+@outbox.handler("stars_invoice")
 async def create_stars_invoice(user_id: int, amount: int, description: str):
     await bot.send_invoice(
         chat_id=user_id,
@@ -760,7 +1142,7 @@ async def process_pre_checkout_query(pre_checkout_query: PreCheckoutQuery):
     await pre_checkout_query.answer(ok=True)
 
 # Обработка успешного платежа
-@dp.message(F.successful_payment)
+@dp.message(F.successful_payment, flags={"throttling": False})
 async def successful_payment_handler(message: types.Message):
     try:
         payload = message.successful_payment.invoice_payload
@@ -769,22 +1151,17 @@ async def successful_payment_handler(message: types.Message):
             user_id = int(parts[2])
             amount_stars = int(parts[3])
             
-            cursor.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
-            cursor.execute("UPDATE users SET stars_balance = stars_balance + ? WHERE user_id=?", 
-                          (amount_stars, user_id))
-            cursor.execute("INSERT INTO deposits (user_id, amount_stars) VALUES (?, ?)", 
-                          (user_id, amount_stars))
-            conn.commit()
-            update_stats()  # Обновляем статистику
+            await record_deposit(user_id, amount_stars)
             
             # Уведомление админу с обработкой ошибок
             try:
-                if get_notifications_enabled(ADMIN_IDS[0]):
+                if await get_notifications_enabled(ADMIN_IDS[0]):
                     username = message.from_user.username or str(user_id)
-                    new_balance = get_stars_balance(user_id)
-                    await bot.send_message(
+                    new_balance = await get_stars_balance(user_id)
+                    await outbox.enqueue(
+                        "send_message",
                         ADMIN_IDS[0],
-                        f"🔔 Пополнение баланса\n"
+                        text=f"🔔 Пополнение баланса\n"
                         f"🆔 ID: {user_id}\n"
                         f"@{username} пополнил свой баланс на {amount_stars} звезд\n"
                         f"💰 Его баланс: {new_balance}"
@@ -794,89 +1171,115 @@ async def successful_payment_handler(message: types.Message):
             
             await message.answer(
                 f"✅ Баланс пополнен на {amount_stars} звезд!\n"
-                f"⭐ Текущий баланс: {get_stars_balance(user_id)}",
+                f"⭐ Текущий баланс: {await get_stars_balance(user_id)}",
                 reply_markup=get_main_menu()
             )
     except Exception as e:
         logger.error(f"Ошибка обработки платежа: {e}")
         await message.answer("⚠️ Ошибка обработки платежа. Обратитесь в поддержку.", reply_markup=get_main_menu())
 
+# Разбор callback_data страницы истории: "<история>" - первая страница,
+# "<история>_older_<date>_<id>" / "<история>_newer_<date>_<id>" - страницы
+# до/после записи с ключом (date, id). Возвращает (newer, cursor).
+def parse_history_callback(data, name):
+    if data == name:
+        return False, None
+    direction, key = data[len(name) + 1:].split("_", 1)
+    date, record_id = key.rsplit("_", 1)
+    return direction == "newer", (date, int(record_id))
+
+# Кнопки листания истории. В строках последние два столбца - ключ (date, id).
+def get_history_keyboard(name, rows, cursor, newer, has_more):
+    has_newer = has_more if newer else cursor is not None
+    has_older = True if newer else has_more
+    
+    nav = []
+    if rows and has_newer:
+        nav.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"{name}_newer_{rows[0][-2]}_{rows[0][-1]}"))
+    if rows and has_older:
+        nav.append(InlineKeyboardButton(text="Старее ➡️", callback_data=f"{name}_older_{rows[-1][-2]}_{rows[-1][-1]}"))
+    
+    buttons = [nav] if nav else []
+    if rows:
+        buttons.append([InlineKeyboardButton(text="📄 Выгрузить в CSV", callback_data=f"export_{name}")])
+    buttons.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_profile")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 # История покупок
-@dp.callback_query(F.data == "purchase_history")
+@dp.callback_query(F.data.startswith("purchase_history"))
 async def purchase_history(callback: types.CallbackQuery):
     user_id = callback.from_user.id
+    newer, cursor = parse_history_callback(callback.data, "purchase_history")
     
-    cursor.execute("""
-        SELECT 
-            p.id,
-            p.product_id,
-            strftime('%d.%m.%Y %H:%M', p.date, 'localtime') as date,
-            COALESCE(pr.name, 'Удалённый товар') as name,
-            COALESCE(pr.stars_price, 0) as price
-        FROM purchases p
-        LEFT JOIN products pr ON p.product_id = pr.id
-        WHERE p.user_id = ?
-        ORDER BY p.date DESC
-        LIMIT 10
-    """, (user_id,))
-    
-    purchases = cursor.fetchall()
+    purchases, has_more = await get_purchase_history(user_id, cursor, newer)
     
     if not purchases:
-        text = "📭 У вас пока нет покупок."
+        text = "📭 У вас пока нет покупок." if cursor is None else "📭 Больше покупок нет."
     else:
-        text = "🛒 История покупок:\n\n"
-        for i, purchase in enumerate(purchases, 1):
-            text += (
-                f"{i}. {purchase[3]}\n"
+        lines = ["🛒 История покупок:\n"]
+        for purchase in purchases:
+            lines.append(
+                f"• {purchase[3]}\n"
                 f"   💫 Цена: {purchase[4]}⭐\n"
                 f"   🕒 Дата: {purchase[2]}\n"
-                f"   🆔 Товара: {purchase[1]}\n\n"
+                f"   🆔 Товара: {purchase[1]}\n"
             )
+        text = "\n".join(lines)
     
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_profile")]
-    ])
-    
+    keyboard = get_history_keyboard("purchase_history", purchases, cursor, newer, has_more)
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 # История пополнений
-@dp.callback_query(F.data == "deposit_history")
+@dp.callback_query(F.data.startswith("deposit_history"))
 async def deposit_history(callback: types.CallbackQuery):
     user_id = callback.from_user.id
-    cursor.execute("""
-        SELECT 
-            amount_stars,
-            strftime('%d.%m.%Y %H:%M', date, 'localtime') as date
-        FROM deposits 
-        WHERE user_id = ? 
-        ORDER BY date DESC 
-        LIMIT 10
-    """, (user_id,))
-    
-    deposits = cursor.fetchall()
+    newer, cursor = parse_history_callback(callback.data, "deposit_history")
+    
+    deposits, has_more = await get_deposit_history(user_id, cursor, newer)
     
     if not deposits:
-        text = "📭 У вас пока нет пополнений."
+        text = "📭 У вас пока нет пополнений." if cursor is None else "📭 Больше пополнений нет."
     else:
-        text = "📈 История пополнений:\n\n"
-        for i, deposit in enumerate(deposits, 1):
-            text += f"{i}. +{deposit[0]}⭐\n   🕒 {deposit[1]}\n"
-    
-    keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_profile")]
-    ])
+        lines = ["📈 История пополнений:\n"]
+        for deposit in deposits:
+            lines.append(f"• +{deposit[0]}⭐\n   🕒 {deposit[1]}")
+        text = "\n".join(lines)
     
+    keyboard = get_history_keyboard("deposit_history", deposits, cursor, newer, has_more)
     await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
+# Выгрузка всей истории в CSV-файл
+@dp.callback_query(F.data.in_({"export_purchase_history", "export_deposit_history"}), flags={"throttling": "export"})
+async def export_history(callback: types.CallbackQuery):
+    kind = callback.data[len("export_"):]
+    await callback.answer("⏳ Готовлю файл...")
+    
+    path, count = await export_history_csv(callback.from_user.id, kind)
+    try:
+        if count == 0:
+            await callback.message.answer("📭 История пуста.")
+            return
+        filename = "purchases.csv" if kind == "purchase_history" else "deposits.csv"
+        await callback.message.answer_document(
+            FSInputFile(path, filename=filename),
+            caption=f"📄 Записей: {count}"
+        )
+    finally:
+        os.remove(path)
+
 # Возврат в профиль
 @dp.callback_query(F.data == "back_to_profile")
 async def back_to_profile(callback: types.CallbackQuery):
     await profile(callback.message)
     await callback.answer()
 
+# Возврат из админ меню в главное меню
+@dp.message(F.text == "🔙 В главное меню")
+async def back_to_main_menu(message: types.Message):
+    await message.answer("🔙 Вернулись в главное меню!", reply_markup=get_main_menu())
+
 # Возврат в главное меню
 @dp.callback_query(F.data == "back_to_main")
 async def back_to_main(callback: types.CallbackQuery):
@@ -897,13 +1300,169 @@ async def support(message: types.Message):
         reply_markup=get_main_menu()
     )
 
+# Поиск товаров по названию и описанию. Запрос хранится в данных FSM
+# для листания страниц результатов.
+async def get_search_results(query, offset):
+    rows, has_next = await search_products(query, offset)
+    if not rows:
+        return f"🔎 По запросу «{html.escape(query)}» ничего не найдено.", None
+    
+    builder = InlineKeyboardBuilder()
+    for id, name, stars_price in rows:
+        builder.row(InlineKeyboardButton(text=f"{name} - {stars_price}⭐", callback_data=f"view_{id}"))
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"search_{max(offset - CATALOG_PAGE_SIZE, 0)}"))
+    if has_next:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"search_{offset + CATALOG_PAGE_SIZE}"))
+    if nav:
+        builder.row(*nav)
+    return f"🔎 Результаты по запросу «{html.escape(query)}»:", builder.as_markup()
+
+async def answer_search(message: types.Message, state: FSMContext, query):
+    await state.update_data(search_query=query)
+    text, markup = await get_search_results(query, 0)
+    await message.answer(text, reply_markup=markup)
+
+@dp.message(Command("search"), flags={"throttling": "search"})
+async def search_command(message: types.Message, command: CommandObject, state: FSMContext):
+    if command.args:
+        await answer_search(message, state, command.args)
+        return
+    await message.answer("Введите название или описание товара:")
+    await state.set_state(Form.search_query)
+
+@dp.message(F.text == "🔎 Поиск")
+async def search_start(message: types.Message, state: FSMContext):
+    await message.answer("Введите название или описание товара:")
+    await state.set_state(Form.search_query)
+
+@dp.message(Form.search_query, F.text, flags={"throttling": "search"})
+async def search_query(message: types.Message, state: FSMContext):
+    await state.set_state(None)
+    await answer_search(message, state, message.text)
+
+@dp.callback_query(F.data.startswith("search_"), flags={"throttling": "search"})
+async def search_page(callback: types.CallbackQuery, state: FSMContext):
+    query = (await state.get_data()).get("search_query")
+    if not query:
+        await callback.answer("Поиск устарел, введите запрос заново.")
+        return
+    
+    text, markup = await get_search_results(query, int(callback.data.split("_")[1]))
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer()
+
+# Любой другой текст пользователя в главном меню считается поисковым запросом.
+# Обработчик зарегистрирован последним, чтобы не перехватывать кнопки и команды.
+# Сообщения, отправленные через инлайн-режим (via_bot), и текст администраторов
+# поиском не считаются.
+@dp.message(
+    StateFilter(None), F.text, ~F.text.startswith("/"), ~F.via_bot, ~F.from_user.id.in_(ADMIN_IDS),
+    flags={"throttling": "search"}
+)
+async def search_free_text(message: types.Message, state: FSMContext):
+    await answer_search(message, state, message.text)
+
+# Периодическая сверка счётчиков статистики с таблицами
+# и удаление устаревших почасовых сводок
+async def reconcile_stats_periodically():
+    while True:
+        try:
+            await reconcile_stats()
+            await prune_hourly_rollups()
+        except Exception as e:
+            logger.error(f"Ошибка сверки статистики: {e}")
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL)
+
+# Удаление брошенных состояний FSM (для redis истечение настроено в самом хранилище)
+async def cleanup_fsm_states_periodically():
+    while True:
+        try:
+            await cleanup_fsm_states(FSM_STATE_TTL)
+        except Exception as e:
+            logger.error(f"Ошибка очистки состояний FSM: {e}")
+        await asyncio.sleep(3600)
+
+# Удаление файлов товаров, на которые больше нет ссылок
+async def collect_file_garbage_periodically():
+    while True:
+        try:
+            removed = await collect_garbage()
+            if removed:
+                logger.info(f"Удалено неиспользуемых файлов: {removed}")
+        except Exception as e:
+            logger.error(f"Ошибка очистки хранилища файлов: {e}")
+        await asyncio.sleep(FILE_GC_INTERVAL)
+
+# Webhook: Telegram сам присылает апдейты на HTTP-сервер бота.
+# Несколько процессов можно поставить за балансировщик с одним WEBHOOK_URL.
+async def on_webhook_startup(bot: Bot):
+    await bot.set_webhook(
+        f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=dp.resolve_used_update_types()
+    )
+
+# HTTP-приложение, принимающее апдейты на WEBHOOK_PATH. Запросы без
+# заголовка X-Telegram-Bot-Api-Secret-Token с secret_token отклоняются.
+def create_webhook_app(secret_token=WEBHOOK_SECRET or None):
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret_token
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+async def run_webhook():
+    dp.startup.register(on_webhook_startup)
+    
+    app = create_webhook_app()
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 # Запуск бота
 async def main():
-    if not os.path.exists("products_files"):
-        os.makedirs("products_files")
+    if not os.path.exists(PRODUCT_FILES_DIR):
+        os.makedirs(PRODUCT_FILES_DIR)
+    
+    for name, detail in await check_query_plans():
+        logger.warning(f"Запрос {name} выполняется без индекса: {detail}")
+    
+    await sync_catalog(force=True)
+    asyncio.create_task(reconcile_stats_periodically())
+    asyncio.create_task(collect_file_garbage_periodically())
+    if FSM_STORAGE == "sqlite":
+        asyncio.create_task(cleanup_fsm_states_periodically())
+    
+    if METRICS_PORT:
+        await start_metrics_server()
     
     print("Бот запущен...")
-    await dp.start_polling(bot)
+    if WORKERS > 1 and not USE_WEBHOOK:
+        # Очередь сообщений и обработка апдейтов работают в процессах-обработчиках
+        await run_supervisor(bot, dp, WORKERS)
+        return
+    
+    outbox.start()
+    broadcaster.start()
+    try:
+        if USE_WEBHOOK:
+            await run_webhook()
+        else:
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await broadcaster.stop()
+        await outbox.stop()
 
 if __name__ == "__main__":
     asyncio.run(main())
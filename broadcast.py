@@ -0,0 +1,141 @@
+import asyncio
+import logging
+
+from aiogram.exceptions import (
+    TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+from config import (
+    BROADCAST_RATE, BROADCAST_CONCURRENCY, BROADCAST_BATCH_SIZE, BROADCAST_LEASE,
+    create_broadcast, claim_broadcasts, get_broadcast_batch, save_broadcast_progress,
+    finish_broadcast, release_broadcasts, mark_users_blocked
+)
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+SENT = "sent"
+FAILED = "failed"
+BLOCKED = "blocked"
+
+
+# Рассылка сообщения всем пользователям. Пользователи читаются из базы
+# пачками по user_id, после каждой пачки прогресс сохраняется в broadcasts,
+# поэтому после перезапуска рассылка продолжается с места остановки (пачка,
+# прерванная сбоем, может быть отправлена повторно). Рассылку ведёт процесс,
+# взявший её в аренду; аренда продлевается с каждой пачкой, а брошенные
+# рассылки подхватываются фоновой проверкой. Отправка ограничена своим
+# лимитом и общим лимитом очереди сообщений, чтобы оставить место ответам
+# пользователям. Заблокировавшие бота пользователи помечаются is_blocked.
+class Broadcaster:
+    def __init__(self, bot, outbox, rate=BROADCAST_RATE, concurrency=BROADCAST_CONCURRENCY,
+                 batch_size=BROADCAST_BATCH_SIZE, lease=BROADCAST_LEASE):
+        self.bot = bot
+        self.outbox = outbox
+        self.bucket = TokenBucket(rate)
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.lease = lease
+        self._running = {}  # id рассылки -> задача
+        self._watcher = None
+
+    # Рассылка копии сообщения message_id из чата from_chat_id, возвращает её id
+    async def start_broadcast(self, admin_id, from_chat_id, message_id):
+        broadcast_id = await create_broadcast(admin_id, from_chat_id, message_id, self.lease)
+        row = (broadcast_id, admin_id, from_chat_id, message_id, 0, 0, 0, 0)
+        self._running[broadcast_id] = asyncio.create_task(self._run(*row))
+        return broadcast_id
+
+    def start(self):
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        broadcast_ids = list(self._running)
+        tasks = list(self._running.values())
+        if self._watcher is not None:
+            tasks.append(self._watcher)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._running.clear()
+        self._watcher = None
+        # После перезапуска рассылки продолжатся сразу, не дожидаясь конца аренды
+        if broadcast_ids:
+            await release_broadcasts(broadcast_ids)
+
+    # Подхватывает незавершённые рассылки без действующей аренды
+    async def _watch(self):
+        while True:
+            try:
+                for row in await claim_broadcasts(self.lease):
+                    if row[0] not in self._running:
+                        logger.info(f"Продолжение рассылки {row[0]}")
+                        self._running[row[0]] = asyncio.create_task(self._run(*row))
+            except Exception as e:
+                logger.error(f"Ошибка проверки рассылок: {e}")
+            await asyncio.sleep(self.lease / 2)
+
+    async def _run(self, broadcast_id, admin_id, from_chat_id, message_id, last_user_id, sent, failed, blocked):
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def send(user_id):
+            async with semaphore:
+                return await self._send(user_id, from_chat_id, message_id)
+
+        try:
+            while True:
+                user_ids = await get_broadcast_batch(last_user_id, self.batch_size)
+                if not user_ids:
+                    break
+                results = await asyncio.gather(*(send(user_id) for user_id in user_ids))
+
+                sent += results.count(SENT)
+                failed += results.count(FAILED)
+                blocked_ids = [user_id for user_id, result in zip(user_ids, results) if result == BLOCKED]
+                blocked += len(blocked_ids)
+                if blocked_ids:
+                    await mark_users_blocked(blocked_ids)
+
+                last_user_id = user_ids[-1]
+                status = await save_broadcast_progress(
+                    broadcast_id, last_user_id, sent, failed, blocked, self.lease
+                )
+                if status != "running":
+                    logger.info(f"Рассылка {broadcast_id} остановлена")
+                    return
+
+            await finish_broadcast(broadcast_id)
+            await self.outbox.enqueue(
+                "send_message",
+                admin_id,
+                text=f"📣 Рассылка #{broadcast_id} завершена\n"
+                f"✅ Доставлено: {sent}\n"
+                f"🚫 Заблокировали бота: {blocked}\n"
+                f"❌ Ошибок: {failed}"
+            )
+        except Exception as e:
+            # Аренда истечёт, и рассылку продолжит фоновая проверка
+            logger.error(f"Ошибка рассылки {broadcast_id}: {e}")
+        finally:
+            self._running.pop(broadcast_id, None)
+
+    async def _send(self, user_id, from_chat_id, message_id):
+        for attempt in range(3):
+            await self.bucket.acquire()
+            await self.outbox.global_bucket.acquire()
+            try:
+                await self.bot.copy_message(chat_id=user_id, from_chat_id=from_chat_id, message_id=message_id)
+                return SENT
+            except TelegramRetryAfter as e:
+                # Ограничение действует на весь бот
+                self.outbox.global_bucket.block(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramForbiddenError:
+                return BLOCKED
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logger.warning(f"Ошибка отправки рассылки пользователю {user_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+            except Exception as e:
+                logger.warning(f"Не удалось отправить рассылку пользователю {user_id}: {e}")
+                return FAILED
+        return FAILED
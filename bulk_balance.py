@@ -0,0 +1,100 @@
+import codecs
+import csv
+import io
+
+from config import FILE_CHUNK_SIZE, BULK_CHUNK_SIZE, apply_balance_changes
+
+MAX_AMOUNT = 10 ** 9  # Защита от опечаток и переполнения
+
+
+# Строки текстового файла из Telegram по мере загрузки, без чтения целиком
+async def iter_file_lines(bot, file_id):
+    file = await bot.get_file(file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    line_no = 0
+    async for chunk in bot.session.stream_content(url=url, chunk_size=FILE_CHUNK_SIZE, raise_for_status=True):
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            line_no += 1
+            yield line_no, line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer.strip():
+        yield line_no + 1, buffer.rstrip("\r")
+
+
+# (user_id, amount) из строки CSV; разделитель - запятая или точка с запятой
+def parse_balance_row(line):
+    fields = next(csv.reader([line], delimiter=";" if ";" in line else ","))
+    fields = [field.strip() for field in fields]
+    if len(fields) != 2:
+        raise ValueError("ожидается два столбца: user_id, amount")
+    try:
+        user_id = int(fields[0])
+        amount = int(fields[1])
+    except ValueError:
+        raise ValueError("user_id и amount должны быть целыми числами")
+    if user_id <= 0:
+        raise ValueError("user_id должен быть больше 0")
+    if amount == 0 or abs(amount) > MAX_AMOUNT:
+        raise ValueError(f"amount должен быть от 1 до {MAX_AMOUNT} по модулю")
+    return user_id, amount
+
+
+# Итоги массовой операции
+class BulkResult:
+    def __init__(self):
+        self.applied = 0
+        self.credited = 0
+        self.debited = 0
+        self.failures = []  # (строка, user_id, amount, причина)
+
+    def failures_csv(self):
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(("line", "user_id", "amount", "error"))
+        writer.writerows(sorted(self.failures, key=lambda failure: failure[0]))
+        return output.getvalue().encode("utf-8")
+
+
+# Читает CSV (user_id, amount) из Telegram и применяет изменения балансов
+# пачками по chunk_size строк, каждая пачка - одна транзакция. Положительное
+# amount начисляет звёзды, отрицательное списывает (баланс не уходит в минус).
+# on_applied(rows) получает [(user_id, amount, новый баланс)] каждой пачки.
+async def apply_balance_csv(bot, file_id, on_applied=None, chunk_size=BULK_CHUNK_SIZE):
+    result = BulkResult()
+    changes = []
+
+    async def flush():
+        applied, failed = await apply_balance_changes(changes)
+        changes.clear()
+        result.applied += len(applied)
+        for _, amount, _ in applied:
+            if amount > 0:
+                result.credited += amount
+            else:
+                result.debited -= amount
+        result.failures.extend(failed)
+        if applied and on_applied is not None:
+            await on_applied(applied)
+
+    async for line_no, line in iter_file_lines(bot, file_id):
+        if not line.strip():
+            continue
+        try:
+            user_id, amount = parse_balance_row(line)
+        except ValueError as e:
+            # Первая строка может быть заголовком
+            if line_no == 1 and not line.lstrip()[:1].isdigit():
+                continue
+            result.failures.append((line_no, "", "", str(e)))
+            continue
+        changes.append((line_no, user_id, amount))
+        if len(changes) >= chunk_size:
+            await flush()
+
+    if changes:
+        await flush()
+    return result
@@ -1,11 +1,78 @@
 import sqlite3
 import os
+import json
+import re
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from user_cache import UserCache
+
+# Наблюдатели запросов: observer(query, seconds) вызывается после каждого
+# выполнения SQL (метрики и т.п.). Пока наблюдателей нет, время не замеряется.
+_query_observers = []
+
+def add_query_observer(observer):
+    _query_observers.append(observer)
+
+def _notify_query_observers(query, started):
+    elapsed = time.perf_counter() - started
+    for observer in _query_observers:
+        observer(query, elapsed)
+
+class _ObservedCursor(sqlite3.Cursor):
+    def execute(self, query, params=()):
+        if not _query_observers:
+            return super().execute(query, params)
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params)
+        finally:
+            _notify_query_observers(query, started)
+
+    def executemany(self, query, seq_of_params):
+        if not _query_observers:
+            return super().executemany(query, seq_of_params)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, seq_of_params)
+        finally:
+            _notify_query_observers(query, started)
+
+class _ObservedConnection(sqlite3.Connection):
+    def cursor(self, factory=_ObservedCursor):
+        return super().cursor(factory)
+
+    def execute(self, query, params=()):
+        return self.cursor().execute(query, params)
+
+    def executemany(self, query, seq_of_params):
+        return self.cursor().executemany(query, seq_of_params)
+
+# Подключение к базе с настройками производительности
+def connect_db(read_only=False):
+    if read_only:
+        conn = sqlite3.connect(
+            f"file:{DB_PATH}?mode=ro", uri=True, check_same_thread=False, factory=_ObservedConnection
+        )
+    else:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, factory=_ObservedConnection)
+    conn.execute(f"PRAGMA busy_timeout = {int(DB_BUSY_TIMEOUT)}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = {int(DB_CACHE_SIZE)}")
+    conn.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)}")
+    return conn
 
 # Настройки базы данных
 def init_db():
-    conn = sqlite3.connect('shop.db', check_same_thread=False)
+    conn = connect_db()
     cursor = conn.cursor()
     
+    # WAL: читатели не блокируются записью и наоборот
+    cursor.execute("PRAGMA journal_mode = WAL")
+    
     # Создание таблицы users
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -30,6 +97,15 @@ def init_db():
         )
     ''')
     
+    # Telegram file_id для повторной отправки товара без загрузки с диска
+    cursor.execute("PRAGMA table_info(products)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "file_id" not in columns:
+        cursor.execute("ALTER TABLE products ADD COLUMN file_id TEXT")
+    # Исходное имя файла: в хранилище файлы лежат под хэшем содержимого
+    if "file_name" not in columns:
+        cursor.execute("ALTER TABLE products ADD COLUMN file_name TEXT")
+    
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS purchases (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -48,6 +124,138 @@ def init_db():
         )
     ''')
     
+    # Версия каталога: увеличивается при любом изменении товаров, по ней
+    # процессы бота узнают, что их копия каталога устарела. Изменённая строка
+    # получает новую версию, удалённая - запись в product_tombstones, так что
+    # процессы дочитывают только изменения.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO catalog_meta (id, version) VALUES (1, 0)")
+    cursor.execute("PRAGMA table_info(products)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "version" not in columns:
+        cursor.execute("ALTER TABLE products ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        # Уже существующие товары получают новую версию, иначе процессы,
+        # дочитывающие изменения после версии 0, их не увидят
+        cursor.execute("UPDATE catalog_meta SET version = version + 1 WHERE id = 1")
+        cursor.execute("UPDATE products SET version = (SELECT version FROM catalog_meta WHERE id = 1)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_version ON products (version)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_tombstones (
+            id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_tombstones_version ON product_tombstones (version)")
+    # Пересоздание триггеров в одной транзакции: другие процессы не увидят
+    # products без триггеров версий
+    cursor.executescript('''
+        BEGIN IMMEDIATE;
+        DROP TRIGGER IF EXISTS catalog_products_insert;
+        DROP TRIGGER IF EXISTS catalog_products_update;
+        DROP TRIGGER IF EXISTS catalog_products_delete;
+        CREATE TRIGGER catalog_products_insert AFTER INSERT ON products
+        BEGIN
+            UPDATE catalog_meta SET version = version + 1 WHERE id = 1;
+            UPDATE products SET version = (SELECT version FROM catalog_meta WHERE id = 1) WHERE id = NEW.id;
+            DELETE FROM product_tombstones WHERE id = NEW.id;
+        END;
+        CREATE TRIGGER catalog_products_update AFTER UPDATE OF name, stars_price, desc, file_path, file_name ON products
+        BEGIN
+            UPDATE catalog_meta SET version = version + 1 WHERE id = 1;
+            UPDATE products SET version = (SELECT version FROM catalog_meta WHERE id = 1) WHERE id = NEW.id;
+        END;
+        CREATE TRIGGER catalog_products_delete AFTER DELETE ON products
+        BEGIN
+            UPDATE catalog_meta SET version = version + 1 WHERE id = 1;
+            INSERT OR REPLACE INTO product_tombstones (id, version)
+                VALUES (OLD.id, (SELECT version FROM catalog_meta WHERE id = 1));
+        END;
+        COMMIT;
+    ''')
+    
+    # Файлы товаров в хранилище по SHA-256 содержимого. refcount - число
+    # товаров, ссылающихся на файл; его ведут триггеры на products.
+    # Файлы без ссылок удаляет сборщик мусора (file_store.collect_garbage).
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS file_blobs (
+            sha256 TEXT PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_blobs_refcount ON file_blobs (refcount, created_at)")
+    cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS file_blobs_products_insert AFTER INSERT ON products
+        BEGIN
+            UPDATE file_blobs SET refcount = refcount + 1 WHERE path = NEW.file_path;
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_blobs_products_update AFTER UPDATE OF file_path ON products
+        WHEN OLD.file_path IS NOT NEW.file_path
+        BEGIN
+            UPDATE file_blobs SET refcount = refcount - 1 WHERE path = OLD.file_path;
+            UPDATE file_blobs SET refcount = refcount + 1 WHERE path = NEW.file_path;
+        END;
+        CREATE TRIGGER IF NOT EXISTS file_blobs_products_delete AFTER DELETE ON products
+        BEGIN
+            UPDATE file_blobs SET refcount = refcount - 1 WHERE path = OLD.file_path;
+        END;
+    ''')
+    
+    # Полнотекстовый индекс товаров (FTS5) по названию и описанию.
+    # Хранит только индекс, тексты берутся из products; синхронизируется триггерами.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'products_fts'")
+    fts_exists = cursor.fetchone() is not None
+    cursor.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, desc, content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    if not fts_exists:
+        cursor.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+    cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+        BEGIN
+            INSERT INTO products_fts (rowid, name, desc) VALUES (NEW.id, NEW.name, NEW.desc);
+        END;
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, desc ON products
+        BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, desc) VALUES ('delete', OLD.id, OLD.name, OLD.desc);
+            INSERT INTO products_fts (rowid, name, desc) VALUES (NEW.id, NEW.name, NEW.desc);
+        END;
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+        BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, desc) VALUES ('delete', OLD.id, OLD.name, OLD.desc);
+        END;
+    ''')
+    
+    # Ключ идемпотентности покупки: повторное нажатие "Подтвердить"
+    # не создаёт вторую покупку
+    cursor.execute("PRAGMA table_info(purchases)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "idempotency_key" not in columns:
+        cursor.execute("ALTER TABLE purchases ADD COLUMN idempotency_key TEXT")
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_purchases_idempotency ON purchases (idempotency_key)")
+    
+    # Цена на момент покупки: выручка не меняется при изменении цены товара.
+    # Старым покупкам проставляется текущая цена товара.
+    if "price" not in columns:
+        cursor.execute("ALTER TABLE purchases ADD COLUMN price INTEGER")
+        cursor.execute("UPDATE purchases SET price = (SELECT stars_price FROM products WHERE products.id = purchases.product_id)")
+    
+    # Индексы для истории покупок/пополнений и подсчёта покупок пользователя
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user_date ON purchases (user_id, date)")
+    # id входит в индекс явно: история листается по ключу (date, id)
+    cursor.execute("DROP INDEX IF EXISTS idx_deposits_user_date")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_deposits_user_date_id ON deposits (user_id, date, id, amount_stars)")
+    
     # Новая таблица для статистики
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS stats (
@@ -59,64 +267,527 @@ def init_db():
         )
     ''')
     
+    # Очередь исходящих сообщений
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            method TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            params TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL DEFAULT 0
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_outbox_next_attempt ON outbox (next_attempt_at)")
+    
+    # Пользователи, заблокировавшие бота, пропускаются рассылками
+    cursor.execute("PRAGMA table_info(users)")
+    columns = [row[1] for row in cursor.fetchall()]
+    if "is_blocked" not in columns:
+        cursor.execute("ALTER TABLE users ADD COLUMN is_blocked INTEGER NOT NULL DEFAULT 0")
+    
+    # Рассылки: копия сообщения admin'а всем пользователям. last_user_id -
+    # последний обработанный пользователь, lease_until - аренда процесса,
+    # который ведёт рассылку.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            from_chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running',
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            lease_until REAL NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts (status)")
+    
+    # Состояния FSM (мастер добавления товара, пополнение и т.д.)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_updated ON fsm_states (updated_at)")
+    
     # Инициализация статистики, если таблица пустая
     cursor.execute("SELECT COUNT(*) FROM stats")
     if cursor.fetchone()[0] == 0:
         cursor.execute("INSERT INTO stats (id) VALUES (1)")
         conn.commit()
     
-    return conn, cursor
+    # Триггеры поддерживают счётчики статистики инкрементально
+    # в той же транзакции, что и сама запись
+    cursor.executescript('''
+        CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users
+        BEGIN
+            UPDATE stats SET total_users = total_users + 1 WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users
+        BEGIN
+            UPDATE stats SET total_users = total_users - 1 WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_purchases_insert AFTER INSERT ON purchases
+        BEGIN
+            UPDATE stats SET total_purchases = total_purchases + 1 WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_purchases_delete AFTER DELETE ON purchases
+        BEGIN
+            UPDATE stats SET total_purchases = total_purchases - 1 WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_deposits_insert AFTER INSERT ON deposits
+        BEGIN
+            UPDATE stats SET total_stars_deposited = total_stars_deposited + COALESCE(NEW.amount_stars, 0) WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS stats_deposits_delete AFTER DELETE ON deposits
+        BEGIN
+            UPDATE stats SET total_stars_deposited = total_stars_deposited - COALESCE(OLD.amount_stars, 0) WHERE id = 1;
+        END;
+    ''')
+    
+    # Сводки по часам и дням (UTC): продажи по товарам и активность
+    # (пополнения, новые пользователи). Триггеры обновляют их в той же
+    # транзакции, что и запись, поэтому экран статистики читает только сводки
+    # и не зависит от размера purchases и deposits.
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='sales_daily'")
+    rollups_exist = cursor.fetchone() is not None
+    cursor.executescript('''
+        CREATE TABLE IF NOT EXISTS sales_hourly (
+            hour TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            purchases INTEGER NOT NULL DEFAULT 0,
+            revenue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (hour, product_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sales_daily (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            purchases INTEGER NOT NULL DEFAULT 0,
+            revenue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, product_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS activity_hourly (
+            hour TEXT PRIMARY KEY,
+            deposits INTEGER NOT NULL DEFAULT 0,
+            deposited INTEGER NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS activity_daily (
+            day TEXT PRIMARY KEY,
+            deposits INTEGER NOT NULL DEFAULT 0,
+            deposited INTEGER NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID;
+        
+        CREATE TRIGGER IF NOT EXISTS rollup_purchases_insert AFTER INSERT ON purchases
+        BEGIN
+            INSERT INTO sales_hourly (hour, product_id, purchases, revenue)
+            VALUES (strftime('%Y-%m-%d %H:00:00', NEW.date), NEW.product_id, 1, COALESCE(NEW.price, 0))
+            ON CONFLICT (hour, product_id) DO UPDATE SET purchases = purchases + 1, revenue = revenue + excluded.revenue;
+            INSERT INTO sales_daily (day, product_id, purchases, revenue)
+            VALUES (date(NEW.date), NEW.product_id, 1, COALESCE(NEW.price, 0))
+            ON CONFLICT (day, product_id) DO UPDATE SET purchases = purchases + 1, revenue = revenue + excluded.revenue;
+        END;
+        CREATE TRIGGER IF NOT EXISTS rollup_purchases_delete AFTER DELETE ON purchases
+        BEGIN
+            UPDATE sales_hourly SET purchases = purchases - 1, revenue = revenue - COALESCE(OLD.price, 0)
+            WHERE hour = strftime('%Y-%m-%d %H:00:00', OLD.date) AND product_id = OLD.product_id;
+            UPDATE sales_daily SET purchases = purchases - 1, revenue = revenue - COALESCE(OLD.price, 0)
+            WHERE day = date(OLD.date) AND product_id = OLD.product_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS rollup_deposits_insert AFTER INSERT ON deposits
+        BEGIN
+            INSERT INTO activity_hourly (hour, deposits, deposited)
+            VALUES (strftime('%Y-%m-%d %H:00:00', NEW.date), 1, COALESCE(NEW.amount_stars, 0))
+            ON CONFLICT (hour) DO UPDATE SET deposits = deposits + 1, deposited = deposited + excluded.deposited;
+            INSERT INTO activity_daily (day, deposits, deposited)
+            VALUES (date(NEW.date), 1, COALESCE(NEW.amount_stars, 0))
+            ON CONFLICT (day) DO UPDATE SET deposits = deposits + 1, deposited = deposited + excluded.deposited;
+        END;
+        CREATE TRIGGER IF NOT EXISTS rollup_deposits_delete AFTER DELETE ON deposits
+        BEGIN
+            UPDATE activity_hourly SET deposits = deposits - 1, deposited = deposited - COALESCE(OLD.amount_stars, 0)
+            WHERE hour = strftime('%Y-%m-%d %H:00:00', OLD.date);
+            UPDATE activity_daily SET deposits = deposits - 1, deposited = deposited - COALESCE(OLD.amount_stars, 0)
+            WHERE day = date(OLD.date);
+        END;
+        -- У пользователей нет даты регистрации, поэтому учитывается момент вставки
+        CREATE TRIGGER IF NOT EXISTS rollup_users_insert AFTER INSERT ON users
+        BEGIN
+            INSERT INTO activity_hourly (hour, new_users) VALUES (strftime('%Y-%m-%d %H:00:00', 'now'), 1)
+            ON CONFLICT (hour) DO UPDATE SET new_users = new_users + 1;
+            INSERT INTO activity_daily (day, new_users) VALUES (date('now'), 1)
+            ON CONFLICT (day) DO UPDATE SET new_users = new_users + 1;
+        END;
+    ''')
+    # Сводки, созданные в существующей базе, заполняются по уже накопленным данным
+    if not rollups_exist:
+        cursor.executescript('''
+            INSERT INTO sales_hourly (hour, product_id, purchases, revenue)
+            SELECT strftime('%Y-%m-%d %H:00:00', date), product_id, COUNT(*), SUM(COALESCE(price, 0))
+            FROM purchases GROUP BY 1, 2;
+            INSERT INTO sales_daily (day, product_id, purchases, revenue)
+            SELECT date(date), product_id, COUNT(*), SUM(COALESCE(price, 0))
+            FROM purchases GROUP BY 1, 2;
+            INSERT INTO activity_hourly (hour, deposits, deposited)
+            SELECT strftime('%Y-%m-%d %H:00:00', date), COUNT(*), SUM(COALESCE(amount_stars, 0))
+            FROM deposits GROUP BY 1;
+            INSERT INTO activity_daily (day, deposits, deposited)
+            SELECT date(date), COUNT(*), SUM(COALESCE(amount_stars, 0))
+            FROM deposits GROUP BY 1;
+        ''')
+    
+    return conn
 
 # Конфигурационные параметры
-TOKEN = "
+TOKEN = ""
 SUPPORT_USERNAME = ""
 ADMIN_IDS = []  # ID админа для уведомлений
 
+# База данных
+DB_PATH = "shop.db"
+DB_SYNCHRONOUS = "NORMAL"  # В режиме WAL NORMAL не теряет целостность, но быстрее FULL
+DB_MMAP_SIZE = 64 * 1024 * 1024  # Байт базы, читаемых через mmap
+DB_CACHE_SIZE = -16000  # Кэш страниц; отрицательное значение - в КиБ (16 МБ)
+DB_BUSY_TIMEOUT = 5000  # Ожидание блокировки, мс
+DB_READ_POOL_SIZE = 4  # Соединений только для чтения
+STATS_RECONCILE_INTERVAL = 3600  # Период полной сверки статистики, секунды
+STATS_HOURLY_RETENTION = 3  # Сколько дней хранить почасовые сводки (дневные хранятся всегда)
+STATS_TOP_PRODUCTS = 15  # Товаров в отчёте продаж по товарам
+CATALOG_PAGE_SIZE = 10  # Количество товаров на одной странице каталога
+HISTORY_PAGE_SIZE = 10  # Записей на странице истории покупок/пополнений
+HISTORY_EXPORT_CHUNK = 1000  # Строк истории, читаемых из базы за раз при выгрузке в CSV
+PRODUCT_FILES_DIR = "products_files"
+FILE_CHUNK_SIZE = 256 * 1024  # Размер части при потоковой загрузке файла, байт
+FILE_GC_GRACE = 3600  # Через сколько секунд удаляется файл, на который не ссылается ни один товар
+FILE_GC_INTERVAL = 6 * 3600  # Период сборки мусора в хранилище файлов, секунды
+BULK_CHUNK_SIZE = 500  # Строк CSV в одной транзакции массового изменения балансов
+BULK_NOTIFY_RATE = 10  # Уведомлений в секунду при массовом начислении (меньше OUTBOX_GLOBAL_RATE)
+INLINE_PAGE_SIZE = 20  # Результатов на странице инлайн-режима (не больше 50)
+INLINE_CACHE_TIME = 300  # Сколько секунд Telegram кэширует ответ на инлайн-запрос
+CATALOG_SYNC_INTERVAL = 1.0  # Как часто (секунды) проверять, не изменили ли каталог другие процессы
+
+# Количество процессов-обработчиков. При значении больше 1 основной процесс
+# получает апдейты (long polling) и распределяет их по процессам по user_id
+WORKERS = 1
+
+# Получение апдейтов через webhook вместо long polling
+USE_WEBHOOK = False
+WEBHOOK_URL = ""  # Публичный HTTPS-адрес бота (TLS завершается на прокси), например https://shop.example.com
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = ""  # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBAPP_HOST = "0.0.0.0"  # Адрес и порт HTTP-сервера за прокси
+WEBAPP_PORT = 8080
+
+# Защита от флуда: (запросов в секунду, сколько подряд без ожидания) для
+# каждого класса обработчиков. Класс задаётся флагом throttling обработчика,
+# без флага используется "default". Администраторы не ограничиваются.
+THROTTLE_RATES = {
+    "default": (2, 10),
+    "start": (0.2, 3),  # /start
+    "buy": (0.5, 3),  # Покупка и подтверждение покупки
+    "search": (1, 5),  # Поиск и инлайн-режим
+    "export": (1 / 60, 2),  # Выгрузка истории в CSV
+}
+THROTTLE_DUPLICATE_WINDOW = 1.0  # Повторное нажатие той же кнопки в течение стольких секунд игнорируется
+THROTTLE_WARN_INTERVAL = 10  # Предупреждать о превышении не чаще раза в столько секунд
+THROTTLE_TTL = 300  # Через сколько секунд бездействия счётчики пользователя удаляются
+
+# Очередь исходящих сообщений (лимиты Telegram: ~30 сообщений/с всего, ~1/с в один чат)
+OUTBOX_GLOBAL_RATE = 30  # Сообщений в секунду на весь бот
+OUTBOX_CHAT_RATE = 1  # Сообщений в секунду в один чат
+OUTBOX_CHAT_BURST = 3  # Сколько сообщений подряд можно отправить в чат без ожидания
+OUTBOX_WORKERS = 8  # Одновременных отправок
+OUTBOX_MAX_ATTEMPTS = 5  # Попыток при сетевых ошибках
+OUTBOX_LEASE = 300  # На сколько секунд задание закрепляется за отправителем
+
+# Рассылки (/broadcast)
+BROADCAST_RATE = 20  # Сообщений в секунду; остаток общего лимита остаётся обычным сообщениям
+BROADCAST_CONCURRENCY = 10  # Одновременных отправок
+BROADCAST_BATCH_SIZE = 100  # Пользователей в пачке; прогресс сохраняется после каждой
+BROADCAST_LEASE = 120  # Через сколько секунд рассылку упавшего процесса подхватит другой
+
+# Хранилище состояний FSM: "sqlite" (в базе бота), "redis" или "memory"
+FSM_STORAGE = "sqlite"
+REDIS_URL = "redis://localhost:6379/0"
+FSM_STATE_TTL = 24 * 3600  # Через сколько секунд брошенное состояние удаляется
+
+# Кэш балансов и настроек пользователей в памяти процесса
+USER_CACHE_SIZE = 10000  # Пользователей в кэше
+USER_CACHE_TTL = 30  # Секунд; ограничивает устаревание при WORKERS > 1 и нескольких серверах
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics.
+# Процессы-обработчики (WORKERS > 1) слушают METRICS_PORT + 1, + 2 и т.д.
+# 0 - не запускать.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+
+# Профилировщик SQL: статистика по запросам (/slowqueries) и журнал
+# запросов дольше SLOW_QUERY_THRESHOLD секунд с их планом выполнения
+QUERY_PROFILER = True
+SLOW_QUERY_THRESHOLD = 0.1
+
 # Инициализация базы данных
-conn, cursor = init_db()
+_conn = init_db()
+
+# Все обращения к SQLite выполняются в отдельных потоках, чтобы медленный
+# commit не блокировал event loop и обработку апдейтов других пользователей.
+# Запись идёт через единственное соединение в одном потоке, чтение - через
+# пул соединений только для чтения, поэтому каталог, профиль и история
+# не ждут завершения записи покупок (режим WAL).
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+_read_executor = ThreadPoolExecutor(max_workers=DB_READ_POOL_SIZE, thread_name_prefix="sqlite-read")
+_read_local = threading.local()
+
+def _read_conn():
+    conn = getattr(_read_local, "conn", None)
+    if conn is None:
+        conn = _read_local.conn = connect_db(read_only=True)
+    return conn
+
+def db_write_queue_size():
+    return _db_executor._work_queue.qsize()
+
+async def run_db(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, func, *args)
 
-# Загрузка товаров
-def load_products():
+# func выполняется в потоке чтения и получает соединение через _read_conn()
+async def run_read(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_read_executor, func, *args)
+
+def _fetchone(query, params):
+    return _read_conn().execute(query, params).fetchone()
+
+def _fetchall(query, params):
+    return _read_conn().execute(query, params).fetchall()
+
+def _execute(query, params):
+    try:
+        cur = _conn.execute(query, params)
+        _conn.commit()
+        return cur.rowcount
+    except Exception:
+        _conn.rollback()
+        raise
+
+def _transaction(func, args):
+    cur = _conn.cursor()
     try:
-        cursor.execute("SELECT id, name, stars_price, desc, file_path FROM products")
-        products_db = cursor.fetchall()
-        products = {}
-        for product in products_db:
-            products[product[0]] = {
-                "name": product[1],
-                "stars_price": product[2],
-                "desc": product[3],
-                "file_path": product[4]
-            }
-        return products
-    except Exception as e:
-        print(f"Ошибка загрузки товаров: {e}")
-        return {}
-
-products = load_products()
+        result = func(cur, *args)
+        _conn.commit()
+        return result
+    except Exception:
+        _conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+async def db_fetchone(query, params=()):
+    return await run_read(_fetchone, query, params)
+
+async def db_fetchall(query, params=()):
+    return await run_read(_fetchall, query, params)
+
+async def db_execute(query, params=()):
+    return await run_db(_execute, query, params)
+
+async def db_transaction(func, *args):
+    # func(cursor, *args) выполняется в потоке БД в одной транзакции
+    return await run_db(_transaction, func, args)
+
+# Изменения товаров после версии каталога since: (версия, изменённые строки,
+# id удалённых товаров) или None, если каталог не менялся. Читается одним
+# снимком, чтобы версия соответствовала строкам.
+def _get_product_changes(since):
+    conn = _read_conn()
+    conn.execute("BEGIN")
+    try:
+        version = conn.execute(CATALOG_VERSION_QUERY).fetchone()[0]
+        if version == since:
+            return None
+        rows = conn.execute(PRODUCT_CHANGES_QUERY, (since,)).fetchall()
+        deleted_ids = [row[0] for row in conn.execute(PRODUCT_TOMBSTONES_QUERY, (since,)).fetchall()]
+        return version, rows, deleted_ids
+    finally:
+        conn.execute("COMMIT")
+
+async def get_product_changes(since):
+    return await run_read(_get_product_changes, since)
+
+# Запросы горячих путей. Планы этих запросов проверяются при запуске
+# (check_query_plans) и тестом tests/test_query_plans.py, чтобы не допустить
+# полного сканирования таблиц.
+CATALOG_VERSION_QUERY = "SELECT version FROM catalog_meta WHERE id = 1"
+PRODUCT_CHANGES_QUERY = "SELECT id, name, stars_price, desc, file_path, file_id, file_name FROM products WHERE version > ?"
+PRODUCT_TOMBSTONES_QUERY = "SELECT id FROM product_tombstones WHERE version > ?"
+CATALOG_NEXT_QUERY = "SELECT id, name, stars_price FROM products WHERE id > ? ORDER BY id LIMIT ?"
+CATALOG_PREV_QUERY = "SELECT id, name, stars_price FROM products WHERE id < ? ORDER BY id DESC LIMIT ?"
+CATALOG_HAS_BEFORE_QUERY = "SELECT EXISTS(SELECT 1 FROM products WHERE id < ?)"
+CATALOG_HAS_AFTER_QUERY = "SELECT EXISTS(SELECT 1 FROM products WHERE id > ?)"
+SEARCH_QUERY = """
+    SELECT p.id, p.name, p.stars_price
+    FROM products_fts
+    JOIN products p ON p.id = products_fts.rowid
+    WHERE products_fts MATCH ?
+    ORDER BY bm25(products_fts, 10.0, 1.0), p.id
+    LIMIT ? OFFSET ?
+"""
+CLAIM_OUTBOX_QUERY = """
+    UPDATE outbox SET next_attempt_at = ?
+    WHERE id IN (
+        SELECT id FROM outbox WHERE next_attempt_at <= ? ORDER BY next_attempt_at, id LIMIT ?
+    )
+    RETURNING id, method, chat_id, params, attempts
+"""
+BROADCAST_BATCH_QUERY = "SELECT user_id FROM users WHERE user_id > ? AND is_blocked = 0 ORDER BY user_id LIMIT ?"
+# Статистика за период по сводкам: ключ - столбец периода (hour или day)
+_PERIOD_SALES = "SELECT COALESCE(SUM(purchases), 0), COALESCE(SUM(revenue), 0) FROM sales_{table} WHERE {column} >= ?"
+_PERIOD_ACTIVITY = (
+    "SELECT COALESCE(SUM(deposits), 0), COALESCE(SUM(deposited), 0), COALESCE(SUM(new_users), 0) "
+    "FROM activity_{table} WHERE {column} >= ?"
+)
+PERIOD_STATS_QUERIES = {
+    column: (_PERIOD_SALES.format(table=table, column=column), _PERIOD_ACTIVITY.format(table=table, column=column))
+    for column, table in (("hour", "hourly"), ("day", "daily"))
+}
+PRODUCT_SALES_QUERY = """
+    SELECT s.product_id, COALESCE(p.name, 'Удалённый товар'), SUM(s.purchases), SUM(s.revenue)
+    FROM sales_daily s
+    LEFT JOIN products p ON p.id = s.product_id
+    WHERE s.day >= ?
+    GROUP BY s.product_id
+    HAVING SUM(s.purchases) > 0
+    ORDER BY SUM(s.revenue) DESC, SUM(s.purchases) DESC
+    LIMIT ?
+"""
+USER_QUERY = "SELECT stars_balance, notifications_enabled FROM users WHERE user_id=?"
+PURCHASES_COUNT_QUERY = "SELECT COUNT(*) FROM purchases WHERE user_id=?"
+# История листается по ключу (date, id): страница начинается после
+# последней показанной записи, а не с OFFSET, поэтому дальние страницы
+# читаются так же быстро, как первая. Последние два столбца - ключ записи.
+_PURCHASE_HISTORY_PAGE = """
+    SELECT 
+        p.id,
+        p.product_id,
+        strftime('%d.%m.%Y %H:%M', p.date, 'localtime') as date,
+        COALESCE(pr.name, 'Удалённый товар') as name,
+        COALESCE(p.price, pr.stars_price, 0) as price,
+        p.date,
+        p.id
+    FROM purchases p
+    LEFT JOIN products pr ON p.product_id = pr.id
+    WHERE p.user_id = ? AND (p.date, p.id) {op} (?, ?)
+    ORDER BY p.date {order}, p.id {order}
+    LIMIT ?
+"""
+_DEPOSIT_HISTORY_PAGE = """
+    SELECT 
+        amount_stars,
+        strftime('%d.%m.%Y %H:%M', date, 'localtime') as date,
+        deposits.date,
+        deposits.id
+    FROM deposits 
+    WHERE deposits.user_id = ? AND (deposits.date, deposits.id) {op} (?, ?)
+    ORDER BY deposits.date {order}, deposits.id {order}
+    LIMIT ?
+"""
+PURCHASE_HISTORY_QUERY = _PURCHASE_HISTORY_PAGE.format(op="<", order="DESC")
+PURCHASE_HISTORY_NEWER_QUERY = _PURCHASE_HISTORY_PAGE.format(op=">", order="ASC")
+DEPOSIT_HISTORY_QUERY = _DEPOSIT_HISTORY_PAGE.format(op="<", order="DESC")
+DEPOSIT_HISTORY_NEWER_QUERY = _DEPOSIT_HISTORY_PAGE.format(op=">", order="ASC")
+HISTORY_START = ("9999-12-31 23:59:59", 0)  # Ключ перед самой новой записью
+
+HOT_QUERIES = {
+    "user": (USER_QUERY, (0,)),
+    "purchases_count": (PURCHASES_COUNT_QUERY, (0,)),
+    "purchase_history": (PURCHASE_HISTORY_QUERY, (0, *HISTORY_START, 1)),
+    "purchase_history_newer": (PURCHASE_HISTORY_NEWER_QUERY, (0, *HISTORY_START, 1)),
+    "deposit_history": (DEPOSIT_HISTORY_QUERY, (0, *HISTORY_START, 1)),
+    "deposit_history_newer": (DEPOSIT_HISTORY_NEWER_QUERY, (0, *HISTORY_START, 1)),
+    "catalog_version": (CATALOG_VERSION_QUERY, ()),
+    "product_changes": (PRODUCT_CHANGES_QUERY, (0,)),
+    "product_tombstones": (PRODUCT_TOMBSTONES_QUERY, (0,)),
+    "catalog_next": (CATALOG_NEXT_QUERY, (0, 1)),
+    "catalog_prev": (CATALOG_PREV_QUERY, (0, 1)),
+    "catalog_has_before": (CATALOG_HAS_BEFORE_QUERY, (0,)),
+    "catalog_has_after": (CATALOG_HAS_AFTER_QUERY, (0,)),
+    "search": (SEARCH_QUERY, ("a*", 1, 0)),
+    "claim_outbox": (CLAIM_OUTBOX_QUERY, (0, 0, 1)),
+    "broadcast_batch": (BROADCAST_BATCH_QUERY, (0, 1)),
+    "period_sales_hourly": (PERIOD_STATS_QUERIES["hour"][0], ("",)),
+    "period_activity_hourly": (PERIOD_STATS_QUERIES["hour"][1], ("",)),
+    "period_sales_daily": (PERIOD_STATS_QUERIES["day"][0], ("",)),
+    "period_activity_daily": (PERIOD_STATS_QUERIES["day"][1], ("",)),
+    "product_sales": (PRODUCT_SALES_QUERY, ("", 1)),
+}
+
+# Запросы, которым сортировка во временном B-tree разрешена: сортируются
+# уже отобранные по индексу строки (совпадения поиска для ранжирования,
+# сгруппированные сводки), а не таблица целиком
+SORTED_QUERIES = {"search", "product_sales"}
+
+# Возвращает список (имя запроса, шаг плана) для запросов,
+# которые выполняются полным сканированием или сортировкой во временном B-tree
+def _check_query_plans(queries):
+    problems = []
+    for name, (query, params) in queries.items():
+        for row in _read_conn().execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall():
+            detail = row[3]
+            # Виртуальная таблица FTS5 ищет по своему индексу (MATCH),
+            # CONSTANT ROW - результат SELECT без таблицы
+            if detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail and detail != "SCAN CONSTANT ROW":
+                problems.append((name, detail))
+            elif "TEMP B-TREE" in detail and name not in SORTED_QUERIES:
+                problems.append((name, detail))
+    return problems
+
+async def check_query_plans(queries=None):
+    return await run_read(_check_query_plans, queries or HOT_QUERIES)
+
+_user_cache = UserCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# (stars_balance, notifications_enabled) пользователя или None
+async def _get_user(user_id):
+    row = _user_cache.get(user_id)
+    if row is None:
+        token = _user_cache.token()
+        row = await db_fetchone(USER_QUERY, (user_id,))
+        if row is not None:
+            _user_cache.fill(user_id, token, *row)
+    return row
 
 # Функции для работы с базой данных
-def get_stars_balance(user_id):
-    cursor.execute("SELECT stars_balance FROM users WHERE user_id=?", (user_id,))
-    result = cursor.fetchone()
+async def get_stars_balance(user_id):
+    result = await _get_user(user_id)
     return result[0] if result else 0
 
-def get_purchases_count(user_id):
-    cursor.execute("SELECT COUNT(*) FROM purchases WHERE user_id=?", (user_id,))
-    return cursor.fetchone()[0]
-
-def get_stats():
-    cursor.execute("SELECT total_purchases, total_stars_deposited, total_users FROM stats WHERE id=1")
-    return cursor.fetchone()
-
-def update_stats():
-    cursor.execute("SELECT COUNT(*) FROM purchases")
-    total_purchases = cursor.fetchone()[0]
-    cursor.execute("SELECT SUM(amount_stars) FROM deposits")
-    total_stars_deposited = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT COUNT(*) FROM users")
-    total_users = cursor.fetchone()[0]
-    cursor.execute("""
+async def get_purchases_count(user_id):
+    result = await db_fetchone(PURCHASES_COUNT_QUERY, (user_id,))
+    return result[0]
+
+async def get_stats():
+    return await db_fetchone("SELECT total_purchases, total_stars_deposited, total_users FROM stats WHERE id=1")
+
+# Полный пересчёт статистики. Счётчики обновляются триггерами,
+# поэтому пересчёт нужен только для периодической сверки.
+def _reconcile_stats(cur):
+    cur.execute("SELECT COUNT(*) FROM purchases")
+    total_purchases = cur.fetchone()[0]
+    cur.execute("SELECT SUM(amount_stars) FROM deposits")
+    total_stars_deposited = cur.fetchone()[0] or 0
+    cur.execute("SELECT COUNT(*) FROM users")
+    total_users = cur.fetchone()[0]
+    cur.execute("""
         UPDATE stats SET 
             total_purchases = ?,
             total_stars_deposited = ?,
@@ -124,14 +795,457 @@ def update_stats():
             last_updated = CURRENT_TIMESTAMP
         WHERE id = 1
     """, (total_purchases, total_stars_deposited, total_users))
-    conn.commit()
 
-def get_notifications_enabled(user_id):
-    cursor.execute("SELECT notifications_enabled FROM users WHERE user_id=?", (user_id,))
-    result = cursor.fetchone()
-    return result[0] if result else 1  # По умолчанию уведомления включены
+async def reconcile_stats():
+    await db_transaction(_reconcile_stats)
+
+def _prune_hourly_rollups(cur, before):
+    cur.execute("DELETE FROM sales_hourly WHERE hour < ?", (before,))
+    cur.execute("DELETE FROM activity_hourly WHERE hour < ?", (before,))
+
+# Удаляет почасовые сводки старше STATS_HOURLY_RETENTION дней
+async def prune_hourly_rollups():
+    before = datetime.now(timezone.utc) - timedelta(days=STATS_HOURLY_RETENTION)
+    await db_transaction(_prune_hourly_rollups, before.strftime("%Y-%m-%d %H:00:00"))
+
+# Начало периода статистики в ключах сводок (UTC). days=0 - текущие сутки
+# по местному времени, они считаются по почасовым сводкам; иначе - последние
+# days суток UTC по дневным сводкам.
+def _stats_period(days):
+    if days == 0:
+        start = datetime.now().astimezone().replace(hour=0, minute=0, second=0, microsecond=0)
+        return "hour", start.astimezone(timezone.utc).strftime("%Y-%m-%d %H:00:00")
+    start = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    return "day", start.isoformat()
+
+def _period_stats(column, since):
+    conn = _read_conn()
+    sales_query, activity_query = PERIOD_STATS_QUERIES[column]
+    purchases, revenue = conn.execute(sales_query, (since,)).fetchone()
+    deposits, deposited, new_users = conn.execute(activity_query, (since,)).fetchone()
+    return purchases, revenue, deposits, deposited, new_users
+
+# (покупок, выручка, пополнений, пополнено звёзд, новых пользователей) за период
+async def get_period_stats(days):
+    return await run_read(_period_stats, *_stats_period(days))
+
+# Продажи по товарам за последние days суток: [(product_id, название, покупок, выручка)]
+async def get_product_sales(days, limit=STATS_TOP_PRODUCTS):
+    _, since = _stats_period(days)
+    return await db_fetchall(PRODUCT_SALES_QUERY, (since, limit))
+
+async def get_notifications_enabled(user_id):
+    result = await _get_user(user_id)
+    return result[1] if result else 1  # По умолчанию уведомления включены
+
+def _set_notifications_enabled(cur, user_id, enabled):
+    cur.execute("INSERT OR IGNORE INTO users (user_id, notifications_enabled) VALUES (?, ?)", (user_id, enabled))
+    cur.execute(
+        "UPDATE users SET notifications_enabled = ? WHERE user_id=? RETURNING stars_balance, notifications_enabled",
+        (enabled, user_id)
+    )
+    return cur.fetchall()[0]
+
+async def set_notifications_enabled(user_id, enabled):
+    _user_cache.set(user_id, *await db_transaction(_set_notifications_enabled, user_id, enabled))
+
+def _add_user(cur, user_id):
+    cur.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+    # Пользователь снова запустил бота - рассылки ему снова доставляются
+    cur.execute("UPDATE users SET is_blocked = 0 WHERE user_id=? AND is_blocked = 1", (user_id,))
+
+async def add_user(user_id):
+    await db_transaction(_add_user, user_id)
+
+def _add_stars(cur, user_id, amount):
+    cur.execute("INSERT OR IGNORE INTO users (user_id) VALUES (?)", (user_id,))
+    cur.execute(
+        "UPDATE users SET stars_balance = stars_balance + ? WHERE user_id=? RETURNING stars_balance, notifications_enabled",
+        (amount, user_id)
+    )
+    return cur.fetchall()[0]
+
+# Возвращает новый баланс
+async def add_stars(user_id, amount):
+    row = await db_transaction(_add_stars, user_id, amount)
+    _user_cache.set(user_id, *row)
+    return row[0]
+
+def _remove_stars(cur, user_id, amount):
+    cur.execute(
+        "UPDATE users SET stars_balance = stars_balance - ? WHERE user_id=? AND stars_balance >= ? "
+        "RETURNING stars_balance, notifications_enabled",
+        (amount, user_id, amount)
+    )
+    rows = cur.fetchall()
+    return rows[0] if rows else None
+
+# Списание выполняется одним условным UPDATE: баланс не уйдёт в минус
+# даже при параллельных запросах. Возвращает True, если звезды списаны.
+async def remove_stars(user_id, amount):
+    row = await db_transaction(_remove_stars, user_id, amount)
+    if row is None:
+        _user_cache.invalidate(user_id)
+        return False
+    _user_cache.set(user_id, *row)
+    return True
+
+# Результаты record_purchase
+PURCHASE_OK = "ok"
+PURCHASE_DUPLICATE = "duplicate"
+PURCHASE_INSUFFICIENT = "insufficient"
+
+class _InsufficientStars(Exception):
+    pass
+
+def _record_purchase(cur, user_id, product_id, stars_price, idempotency_key, delivery):
+    cur.execute("INSERT OR IGNORE INTO purchases (user_id, product_id, price, idempotency_key) VALUES (?, ?, ?, ?)", 
+                (user_id, product_id, stars_price, idempotency_key))
+    if cur.rowcount == 0:
+        return PURCHASE_DUPLICATE
+    row = _remove_stars(cur, user_id, stars_price)
+    if row is None:
+        raise _InsufficientStars()  # Откатывает вставку покупки
+    if delivery is not None:
+        method, params = delivery
+        cur.execute(
+            "INSERT INTO outbox (method, chat_id, params) VALUES (?, ?, ?)",
+            (method, user_id, json.dumps({**params, "balance": row[0]}, ensure_ascii=False))
+        )
+    return PURCHASE_OK, row
+
+# Списание и запись покупки в одной транзакции. delivery - (method, params)
+# задания outbox для выдачи товара: оно ставится в той же транзакции, так
+# что оплаченная покупка не останется без выдачи. В params добавляется
+# balance - баланс после списания.
+async def record_purchase(user_id, product_id, stars_price, idempotency_key, delivery=None):
+    try:
+        result = await db_transaction(_record_purchase, user_id, product_id, stars_price, idempotency_key, delivery)
+    except _InsufficientStars:
+        _user_cache.invalidate(user_id)
+        return PURCHASE_INSUFFICIENT
+    if result == PURCHASE_DUPLICATE:
+        return result
+    _user_cache.set(user_id, *result[1])
+    return result[0]
+
+def _record_deposit(cur, user_id, amount_stars):
+    row = _add_stars(cur, user_id, amount_stars)
+    cur.execute("INSERT INTO deposits (user_id, amount_stars) VALUES (?, ?)", 
+                (user_id, amount_stars))
+    return row
+
+# Возвращает новый баланс
+async def record_deposit(user_id, amount_stars):
+    row = await db_transaction(_record_deposit, user_id, amount_stars)
+    _user_cache.set(user_id, *row)
+    return row[0]
+
+# Массовое изменение балансов. changes - [(номер строки, user_id, amount)];
+# списание, после которого баланс ушёл бы в минус, не применяется.
+# Транзакция начинается сразу с блокировки записи, поэтому прочитанные
+# балансы не изменятся до конца пачки. Возвращает (применённые
+# [(user_id, amount, новый баланс)], ошибки [(строка, user_id, amount, причина)]).
+def _apply_balance_changes(cur, changes):
+    cur.execute("BEGIN IMMEDIATE")
+    user_ids = list({user_id for _, user_id, _ in changes})
+    cur.execute(
+        f"SELECT user_id, stars_balance FROM users WHERE user_id IN ({', '.join('?' * len(user_ids))})",
+        user_ids
+    )
+    balances = dict(cur.fetchall())
+    existing = set(balances)
+    
+    applied, failed = [], []
+    for line_no, user_id, amount in changes:
+        balance = balances.get(user_id)
+        if amount < 0 and balance is None:
+            failed.append((line_no, user_id, amount, "пользователь не найден"))
+            continue
+        if amount < 0 and balance + amount < 0:
+            failed.append((line_no, user_id, amount, f"недостаточно звезд, баланс {balance}"))
+            continue
+        balances[user_id] = (balance or 0) + amount
+        applied.append((user_id, amount, balances[user_id]))
+    
+    changed = {user_id for user_id, _, _ in applied}
+    cur.executemany(
+        "INSERT OR IGNORE INTO users (user_id) VALUES (?)",
+        [(user_id,) for user_id in changed - existing]
+    )
+    cur.executemany(
+        "UPDATE users SET stars_balance = ? WHERE user_id = ?",
+        [(balances[user_id], user_id) for user_id in changed]
+    )
+    # Строки изменённых пользователей для записи в кэш
+    rows = []
+    if changed:
+        cur.execute(
+            f"SELECT user_id, stars_balance, notifications_enabled FROM users "
+            f"WHERE user_id IN ({', '.join('?' * len(changed))})",
+            list(changed)
+        )
+        rows = cur.fetchall()
+    return applied, failed, rows
+
+async def apply_balance_changes(changes):
+    applied, failed, rows = await db_transaction(_apply_balance_changes, changes)
+    for user_id, stars_balance, notifications_enabled in rows:
+        _user_cache.set(user_id, stars_balance, notifications_enabled)
+    return applied, failed
+
+def _add_product(cur, name, stars_price, desc, file_path, file_id, file_name):
+    cur.execute("SELECT MAX(id) FROM products")
+    max_id = cur.fetchone()[0] or 0
+    new_id = max_id + 1
+    
+    cur.execute(
+        "INSERT INTO products (id, name, stars_price, desc, file_path, file_id, file_name) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (new_id, name, stars_price, desc, file_path, file_id, file_name)
+    )
+    return new_id
+
+async def add_product(name, stars_price, desc, file_path, file_id=None, file_name=None):
+    return await db_transaction(_add_product, name, stars_price, desc, file_path, file_id, file_name)
+
+# Страница каталога по ключу id (keyset-пагинация): следующая страница
+# начинается после anchor, предыдущая заканчивается перед ним
+def _get_catalog_page(anchor, forward, limit):
+    conn = _read_conn()
+    if forward:
+        rows = conn.execute(CATALOG_NEXT_QUERY, (anchor, limit + 1)).fetchall()
+        has_next = len(rows) > limit
+        rows = rows[:limit]
+        has_prev = bool(rows) and conn.execute(CATALOG_HAS_BEFORE_QUERY, (rows[0][0],)).fetchone()[0]
+    else:
+        rows = conn.execute(CATALOG_PREV_QUERY, (anchor, limit + 1)).fetchall()
+        if not rows:
+            return _get_catalog_page(0, True, limit)
+        has_prev = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_next = conn.execute(CATALOG_HAS_AFTER_QUERY, (rows[-1][0],)).fetchone()[0]
+    return rows, bool(has_prev), bool(has_next)
+
+async def get_catalog_page(anchor=0, forward=True, limit=CATALOG_PAGE_SIZE):
+    return await run_read(_get_catalog_page, anchor, forward, limit)
+
+# Запрос FTS5 из текста пользователя: каждое слово ищется как префикс,
+# все слова должны встретиться. None, если слов нет.
+def make_search_query(text):
+    words = re.findall(r"\w+", text.lower())[:10]
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+# Поиск товаров, лучшие совпадения первыми (совпадение в названии весит больше).
+# Возвращает (строки [id, name, stars_price], есть ли следующая страница).
+def _search_products(match, offset, limit):
+    rows = _read_conn().execute(SEARCH_QUERY, (match, limit + 1, offset)).fetchall()
+    return rows[:limit], len(rows) > limit
+
+async def search_products(text, offset=0, limit=CATALOG_PAGE_SIZE):
+    match = make_search_query(text)
+    if match is None:
+        return [], False
+    return await run_read(_search_products, match, offset, limit)
+
+async def get_product_file_path(product_id):
+    result = await db_fetchone("SELECT file_path FROM products WHERE id=?", (product_id,))
+    return result[0] if result else None
+
+PRODUCT_FIELDS = ("name", "stars_price", "desc", "file_path")
+
+async def update_product_field(product_id, field, value):
+    if field not in PRODUCT_FIELDS:
+        raise ValueError(f"Недопустимое поле товара: {field}")
+    await db_execute(f"UPDATE products SET {field}=? WHERE id=?", (value, product_id))
+
+async def set_product_file(product_id, file_path, file_id, file_name=None):
+    await db_execute(
+        "UPDATE products SET file_path=?, file_id=?, file_name=? WHERE id=?",
+        (file_path, file_id, file_name, product_id)
+    )
+
+# file_id не меняет версию каталога: кэш выдачи Telegram не повод
+# перечитывать товар во всех процессах
+async def set_product_file_id(product_id, file_id):
+    await db_execute("UPDATE products SET file_id=? WHERE id=?", (file_id, product_id))
+
+async def delete_product(product_id):
+    await db_execute("DELETE FROM products WHERE id=?", (product_id,))
+
+# Страница истории, записи от новых к старым. cursor - ключ (date, id)
+# записи, после которой начинается страница: при newer=False берутся более
+# старые записи, при newer=True - более новые. has_more - есть ли записи
+# дальше в том же направлении.
+def _history_page(query, newer_query, user_id, cursor, newer, limit):
+    rows = _read_conn().execute(
+        newer_query if newer else query,
+        (user_id, *(cursor or HISTORY_START), limit + 1)
+    ).fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if newer:
+        rows.reverse()
+    return rows, has_more
+
+async def get_purchase_history(user_id, cursor=None, newer=False, limit=HISTORY_PAGE_SIZE):
+    return await run_read(
+        _history_page, PURCHASE_HISTORY_QUERY, PURCHASE_HISTORY_NEWER_QUERY, user_id, cursor, newer, limit
+    )
+
+async def get_deposit_history(user_id, cursor=None, newer=False, limit=HISTORY_PAGE_SIZE):
+    return await run_read(
+        _history_page, DEPOSIT_HISTORY_QUERY, DEPOSIT_HISTORY_NEWER_QUERY, user_id, cursor, newer, limit
+    )
+
+# Очередь исходящих сообщений
+async def enqueue_outbox(method, chat_id, params):
+    await db_execute(
+        "INSERT INTO outbox (method, chat_id, params) VALUES (?, ?, ?)",
+        (method, chat_id, params)
+    )
+
+def _enqueue_outbox_many(cur, rows):
+    cur.executemany("INSERT INTO outbox (method, chat_id, params, next_attempt_at) VALUES (?, ?, ?, ?)", rows)
+
+# rows - [(method, chat_id, params, next_attempt_at)]
+async def enqueue_outbox_many(rows):
+    await db_transaction(_enqueue_outbox_many, rows)
+
+async def get_outbox_backlog():
+    return (await db_fetchone("SELECT COUNT(*) FROM outbox"))[0]
+
+# Забирает готовые задания одним UPDATE ... RETURNING и продлевает их
+# next_attempt_at на время аренды, чтобы их не взял другой отправитель
+async def claim_outbox(limit, lease):
+    now = time.time()
+    return await db_transaction(lambda cur: cur.execute(CLAIM_OUTBOX_QUERY, (now + lease, now, limit)).fetchall())
+
+async def reschedule_outbox(item_id, attempts, next_attempt_at):
+    await db_execute(
+        "UPDATE outbox SET attempts = ?, next_attempt_at = ? WHERE id = ?",
+        (attempts, next_attempt_at, item_id)
+    )
+
+async def release_outbox(item_ids):
+    await db_transaction(lambda cur: cur.executemany(
+        "UPDATE outbox SET next_attempt_at = 0 WHERE id = ?", [(i,) for i in item_ids]
+    ))
+
+async def delete_outbox(item_id):
+    await db_execute("DELETE FROM outbox WHERE id = ?", (item_id,))
+
+# Рассылки всем пользователям (broadcast.py)
+def _create_broadcast(cur, admin_id, from_chat_id, message_id, lease):
+    cur.execute(
+        "INSERT INTO broadcasts (admin_id, from_chat_id, message_id, lease_until) VALUES (?, ?, ?, ?)",
+        (admin_id, from_chat_id, message_id, time.time() + lease)
+    )
+    return cur.lastrowid
+
+async def create_broadcast(admin_id, from_chat_id, message_id, lease):
+    return await db_transaction(_create_broadcast, admin_id, from_chat_id, message_id, lease)
+
+def _claim_broadcasts(cur, lease):
+    now = time.time()
+    cur.execute(
+        "UPDATE broadcasts SET lease_until = ? WHERE status = 'running' AND lease_until < ? "
+        "RETURNING id, admin_id, from_chat_id, message_id, last_user_id, sent, failed, blocked",
+        (now + lease, now)
+    )
+    return cur.fetchall()
+
+# Берёт в аренду незавершённые рассылки, которые никто не ведёт
+async def claim_broadcasts(lease):
+    return await db_transaction(_claim_broadcasts, lease)
+
+# Следующая пачка получателей рассылки (keyset по user_id)
+async def get_broadcast_batch(after_user_id, limit):
+    rows = await db_fetchall(BROADCAST_BATCH_QUERY, (after_user_id, limit))
+    return [row[0] for row in rows]
+
+def _save_broadcast_progress(cur, broadcast_id, last_user_id, sent, failed, blocked, lease):
+    cur.execute(
+        "UPDATE broadcasts SET last_user_id = ?, sent = ?, failed = ?, blocked = ?, lease_until = ? "
+        "WHERE id = ? RETURNING status",
+        (last_user_id, sent, failed, blocked, time.time() + lease, broadcast_id)
+    )
+    rows = cur.fetchall()
+    return rows[0][0] if rows else None
+
+# Сохраняет прогресс и продлевает аренду, возвращает статус рассылки
+async def save_broadcast_progress(broadcast_id, last_user_id, sent, failed, blocked, lease):
+    return await db_transaction(
+        _save_broadcast_progress, broadcast_id, last_user_id, sent, failed, blocked, lease
+    )
+
+async def finish_broadcast(broadcast_id):
+    await db_execute(
+        "UPDATE broadcasts SET status = 'done', finished_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'",
+        (broadcast_id,)
+    )
+
+async def release_broadcasts(broadcast_ids):
+    placeholders = ", ".join("?" * len(broadcast_ids))
+    await db_execute(f"UPDATE broadcasts SET lease_until = 0 WHERE id IN ({placeholders})", broadcast_ids)
+
+async def cancel_broadcasts():
+    return await db_execute(
+        "UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP WHERE status = 'running'"
+    )
+
+async def get_broadcasts(limit):
+    return await db_fetchall(
+        "SELECT id, status, sent, failed, blocked, created_at FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,)
+    )
+
+def _mark_users_blocked(cur, user_ids):
+    cur.executemany("UPDATE users SET is_blocked = 1 WHERE user_id = ?", [(user_id,) for user_id in user_ids])
+
+async def mark_users_blocked(user_ids):
+    await db_transaction(_mark_users_blocked, user_ids)
+
+# Хранилище состояний FSM
+async def get_fsm_record(key):
+    return await db_fetchone("SELECT state, data FROM fsm_states WHERE key = ?", (key,))
+
+def _save_fsm_field(cur, key, field, value):
+    cur.execute(f"""
+        INSERT INTO fsm_states (key, {field}, updated_at) VALUES (?, ?, ?)
+        ON CONFLICT(key) DO UPDATE SET {field} = excluded.{field}, updated_at = excluded.updated_at
+    """, (key, value, time.time()))
+    # Пустые записи не храним
+    cur.execute("DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND (data IS NULL OR data = '{}')", (key,))
+
+async def save_fsm_state(key, state):
+    await db_transaction(_save_fsm_field, key, "state", state)
+
+async def save_fsm_data(key, data):
+    await db_transaction(_save_fsm_field, key, "data", data)
+
+async def cleanup_fsm_states(ttl):
+    return await db_execute("DELETE FROM fsm_states WHERE updated_at < ?", (time.time() - ttl,))
+
+# Регистрация файла в хранилище. Повторная загрузка того же содержимого
+# обновляет created_at, откладывая удаление файла сборщиком мусора.
+async def register_blob(sha256, path, size):
+    await db_execute(
+        "INSERT INTO file_blobs (sha256, path, size, refcount, created_at) VALUES (?, ?, ?, 0, ?) "
+        "ON CONFLICT(sha256) DO UPDATE SET created_at = excluded.created_at",
+        (sha256, path, size, time.time())
+    )
+
+async def get_blob_paths():
+    return [row[0] for row in await db_fetchall("SELECT path FROM file_blobs")]
+
+def _delete_unreferenced_blobs(cur, grace):
+    cur.execute(
+        "DELETE FROM file_blobs WHERE refcount <= 0 AND created_at < ? RETURNING path",
+        (time.time() - grace,)
+    )
+    return [row[0] for row in cur.fetchall()]
 
-def set_notifications_enabled(user_id, enabled):
-    cursor.execute("INSERT OR IGNORE INTO users (user_id, notifications_enabled) VALUES (?, ?)", (user_id, enabled))
-    cursor.execute("UPDATE users SET notifications_enabled = ? WHERE user_id=?", (enabled, user_id))
-    conn.commit()
+# Удаляет из базы файлы без ссылок старше grace секунд, возвращает их пути
+async def delete_unreferenced_blobs(grace):
+    return await db_transaction(_delete_unreferenced_blobs, grace)
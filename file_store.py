@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+import time
+import uuid
+
+import aiofiles
+
+from config import (
+    PRODUCT_FILES_DIR, FILE_CHUNK_SIZE, FILE_GC_GRACE, register_blob,
+    get_blob_paths, delete_unreferenced_blobs
+)
+
+logger = logging.getLogger(__name__)
+
+BLOBS_DIR = os.path.join(PRODUCT_FILES_DIR, "blobs")
+TMP_DIR = os.path.join(PRODUCT_FILES_DIR, "tmp")
+
+
+def is_blob(path):
+    return os.path.abspath(path).startswith(os.path.abspath(BLOBS_DIR) + os.sep)
+
+
+# Загружает файл из Telegram по частям во временный файл, считая SHA-256 на
+# лету, и кладёт его в хранилище по хэшу содержимого. Одинаковые файлы
+# хранятся один раз; ссылки на них считает база (file_blobs.refcount).
+# Возвращает путь к файлу в хранилище.
+async def store_telegram_file(bot, file_id):
+    file = await bot.get_file(file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+
+    os.makedirs(TMP_DIR, exist_ok=True)
+    tmp_path = os.path.join(TMP_DIR, f"{uuid.uuid4().hex}.part")
+    hasher = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(tmp_path, "wb") as tmp:
+            async for chunk in bot.session.stream_content(url=url, chunk_size=FILE_CHUNK_SIZE, raise_for_status=True):
+                hasher.update(chunk)
+                size += len(chunk)
+                await tmp.write(chunk)
+
+        if file.file_size is not None and size != file.file_size:
+            raise IOError(f"Файл загружен не полностью: {size} из {file.file_size} байт")
+
+        digest = hasher.hexdigest()
+        blob_path = os.path.join(BLOBS_DIR, digest[:2], digest)
+        # Регистрация до переноса файла: свежая запись защищает блоб от сборщика мусора
+        await register_blob(digest, blob_path, size)
+        if os.path.exists(blob_path):
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+        return blob_path
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+# Освобождение файла товара, который больше не используется. Файлы хранилища
+# удаляет сборщик мусора по счётчику ссылок, старые файлы - сразу.
+def release_file(path):
+    if not path or is_blob(path):
+        return
+    if os.path.exists(path):
+        try:
+            os.remove(path)
+        except Exception as e:
+            logger.error(f"Ошибка удаления файла: {e}")
+
+
+# Удаляет блобы без ссылок старше grace секунд, а также файлы хранилища,
+# не зарегистрированные в базе, и брошенные временные файлы
+async def collect_garbage(grace=FILE_GC_GRACE):
+    removed = 0
+    for path in await delete_unreferenced_blobs(grace):
+        if os.path.exists(path):
+            os.remove(path)
+            removed += 1
+
+    known = set(await get_blob_paths())
+    deadline = time.time() - grace
+    for directory in (BLOBS_DIR, TMP_DIR):
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                if path in known or os.path.getmtime(path) > deadline:
+                    continue
+                os.remove(path)
+                removed += 1
+    return removed
@@ -0,0 +1,52 @@
+import json
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import (
+    FSM_STORAGE, REDIS_URL, FSM_STATE_TTL, get_fsm_record,
+    save_fsm_state, save_fsm_data
+)
+
+
+def _make_key(key: StorageKey):
+    return ":".join(str(part) for part in (
+        key.bot_id, key.chat_id, key.user_id, key.thread_id,
+        key.business_connection_id, key.destiny
+    ))
+
+
+# Хранилище FSM в таблице fsm_states. Состояния переживают перезапуск и
+# доступны всем процессам бота, работающим с одной базой. Брошенные
+# состояния удаляются по FSM_STATE_TTL (cleanup_fsm_states).
+class SQLiteStorage(BaseStorage):
+    async def set_state(self, key: StorageKey, state=None):
+        if isinstance(state, State):
+            state = state.state
+        await save_fsm_state(_make_key(key), state)
+
+    async def get_state(self, key: StorageKey):
+        record = await get_fsm_record(_make_key(key))
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data):
+        await save_fsm_data(_make_key(key), json.dumps(dict(data), ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey):
+        record = await get_fsm_record(_make_key(key))
+        return json.loads(record[1]) if record and record[1] else {}
+
+    async def close(self):
+        pass
+
+
+# Хранилище по настройке FSM_STORAGE: "sqlite", "redis" или "memory"
+def create_fsm_storage():
+    if FSM_STORAGE == "redis":
+        # Требует пакет redis (pip install redis)
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    return SQLiteStorage()
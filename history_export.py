@@ -0,0 +1,58 @@
+import csv
+import io
+import os
+import tempfile
+
+import aiofiles
+
+from config import HISTORY_EXPORT_CHUNK, get_purchase_history, get_deposit_history
+
+PURCHASES = "purchase_history"
+DEPOSITS = "deposit_history"
+
+# Заголовок CSV, функция чтения страницы и строка CSV из строки запроса
+_EXPORTS = {
+    PURCHASES: (
+        ("id", "date_utc", "product_id", "product", "price"),
+        get_purchase_history,
+        lambda row: (row[0], row[5], row[1], row[3], row[4])
+    ),
+    DEPOSITS: (
+        ("id", "date_utc", "amount_stars"),
+        get_deposit_history,
+        lambda row: (row[3], row[2], row[0])
+    ),
+}
+
+
+# Выгружает всю историю пользователя во временный CSV-файл. История читается
+# из базы страницами по chunk строк (по ключу (date, id), как при листании),
+# и каждая страница сразу дописывается в файл, поэтому в памяти не бывает
+# больше одной страницы. Возвращает (путь к файлу, количество строк); файл
+# удаляет вызывающий.
+async def export_history_csv(user_id, kind, chunk=HISTORY_EXPORT_CHUNK):
+    header, fetch, to_csv = _EXPORTS[kind]
+    fd, path = tempfile.mkstemp(prefix=f"{kind}_", suffix=".csv")
+    os.close(fd)
+    count = 0
+    try:
+        # utf-8-sig - чтобы Excel правильно показал кириллицу
+        async with aiofiles.open(path, "w", encoding="utf-8-sig", newline="") as file:
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(header)
+            cursor = None
+            while True:
+                rows, has_more = await fetch(user_id, cursor, limit=chunk)
+                writer.writerows(to_csv(row) for row in rows)
+                await file.write(buffer.getvalue())
+                buffer.seek(0)
+                buffer.truncate()
+                count += len(rows)
+                if not has_more:
+                    break
+                cursor = rows[-1][-2:]
+    except Exception:
+        os.remove(path)
+        raise
+    return path, count
@@ -0,0 +1,176 @@
+import bisect
+import inspect
+import threading
+import time
+
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT, add_query_observer, get_outbox_backlog, db_write_queue_size
+from query_profiler import normalized_query
+
+# Метрики в текстовом формате Prometheus. Запись метрики - увеличение
+# счётчика под блокировкой, поэтому их можно обновлять и из потоков базы.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1)
+
+_registry = []
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    async def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = {}  # метки -> [счётчики по корзинам..., сумма]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    async def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, list(counts)) for labels, counts in self._values.items()]
+        names = self.labels + ("le",)
+        for labels, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                lines.append(f"{self.name}_bucket{_format_labels(names, labels + (bound,))} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, labels)} {total}")
+        return lines
+
+
+# Значение считывается при каждом запросе метрик; func может быть корутиной
+class Gauge:
+    def __init__(self, name, description, func):
+        self.name = name
+        self.description = description
+        self.func = func
+        _registry.append(self)
+
+    async def render(self):
+        value = self.func()
+        if inspect.isawaitable(value):
+            value = await value
+        return [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+updates_total = Counter("bot_updates_total", "Полученные апдейты по типу", ("type",))
+handler_seconds = Histogram("bot_handler_seconds", "Время работы обработчика", ("handler",))
+handler_errors = Counter("bot_handler_errors_total", "Исключения в обработчиках", ("handler",))
+query_seconds = Histogram("bot_db_query_seconds", "Время выполнения SQL-запроса", ("query",), QUERY_BUCKETS)
+api_seconds = Histogram("bot_api_request_seconds", "Время запроса к Bot API", ("method",))
+api_errors = Counter("bot_api_errors_total", "Ошибки запросов к Bot API", ("method", "error"))
+
+# Метка - нормализованный текст запроса: списки IN (?, ?, ...) разной длины
+# и литералы не порождают новых серий
+def _observe_query(query, seconds):
+    query_seconds.observe(seconds, normalized_query(query))
+
+
+async def _count_update(handler, event, data):
+    updates_total.inc(event.event_type)
+    return await handler(event, data)
+
+
+async def _measure_handler(handler, event, data):
+    name = data["handler"].callback.__name__
+    started = time.perf_counter()
+    try:
+        return await handler(event, data)
+    except Exception:
+        handler_errors.inc(name)
+        raise
+    finally:
+        handler_seconds.observe(time.perf_counter() - started, name)
+
+
+async def _measure_request(make_request, bot, method):
+    name = method.__api_method__
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except Exception as e:
+        api_errors.inc(name, type(e).__name__)
+        raise
+    finally:
+        api_seconds.observe(time.perf_counter() - started, name)
+
+
+# Подключает сбор метрик к диспетчеру, сессии бота, базе и очереди сообщений
+def setup_metrics(dp, bot, outbox):
+    dp.update.outer_middleware(_count_update)
+    for name, observer in dp.observers.items():
+        if name not in ("update", "error"):
+            observer.middleware(_measure_handler)
+    bot.session.middleware(_measure_request)
+    add_query_observer(_observe_query)
+    Gauge("bot_outbox_queue", "Заданий очереди сообщений, ожидающих отправителя", outbox.qsize)
+    Gauge("bot_outbox_backlog", "Неотправленных заданий в таблице outbox", get_outbox_backlog)
+    Gauge("bot_db_write_queue", "Операций записи в очереди к базе", db_write_queue_size)
+
+
+async def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(await metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle_metrics(request):
+    return web.Response(
+        body=(await render()).encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,153 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from config import (
+    OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE, OUTBOX_CHAT_BURST, OUTBOX_WORKERS,
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_LEASE, enqueue_outbox, enqueue_outbox_many, claim_outbox,
+    delete_outbox, reschedule_outbox, release_outbox
+)
+from ratelimit import TokenBucket, TokenBuckets
+
+logger = logging.getLogger(__name__)
+
+
+# Очередь исходящих сообщений. Задания сохраняются в таблицу outbox и
+# отправляются фоновыми воркерами с соблюдением лимитов Telegram (общий и
+# на каждый чат), с повтором по RetryAfter и сетевым ошибкам. Неотправленные
+# задания переживают перезапуск бота.
+class Outbox:
+    def __init__(self, bot, global_rate=OUTBOX_GLOBAL_RATE, chat_rate=OUTBOX_CHAT_RATE,
+                 chat_burst=OUTBOX_CHAT_BURST, workers=OUTBOX_WORKERS,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, lease=OUTBOX_LEASE):
+        self.bot = bot
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = TokenBuckets(chat_rate, chat_burst)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self._handlers = {}
+        self._queue = None
+        self._wakeup = None
+        self._inflight = set()
+        self._tasks = []
+
+    # Регистрация собственного способа отправки: handler(chat_id, **params)
+    def handler(self, name):
+        def register(func):
+            self._handlers[name] = func
+            return func
+        return register
+
+    # method - имя зарегистрированного обработчика или метода Bot (send_message и т.п.)
+    async def enqueue(self, method, chat_id, **params):
+        await enqueue_outbox(method, chat_id, json.dumps(params, ensure_ascii=False))
+        self.wake()
+
+    # Массовая постановка: items - [(chat_id, params)]. С rate задания
+    # распределяются во времени начиная со start (rate в секунду), чтобы
+    # рассылка не задерживала остальные сообщения. Возвращает время, с
+    # которого можно ставить следующую пачку.
+    async def enqueue_many(self, method, items, rate=None, start=None):
+        start = max(start or 0, time.time())
+        step = 1 / rate if rate else 0
+        rows = [
+            (method, chat_id, json.dumps(params, ensure_ascii=False), start + i * step)
+            for i, (chat_id, params) in enumerate(items)
+        ]
+        await enqueue_outbox_many(rows)
+        self.wake()
+        return start + len(rows) * step
+
+    # Будит отправителя после заданий, записанных в outbox в обход enqueue
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def qsize(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.workers * 2)
+        self._wakeup = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._feed()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        # Взятые, но не отправленные задания сразу возвращаются в очередь
+        if self._inflight:
+            await release_outbox(list(self._inflight))
+            self._inflight.clear()
+
+    # Забирает из БД готовые к отправке задания и раздаёт их воркерам
+    async def _feed(self):
+        while True:
+            try:
+                rows = await claim_outbox(self.workers * 2, self.lease)
+            except Exception as e:
+                logger.error(f"Ошибка чтения очереди сообщений: {e}")
+                rows = []
+
+            for row in rows:
+                if row[0] in self._inflight:
+                    continue
+                self._inflight.add(row[0])
+                await self._queue.put(row)
+
+            if not rows:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _work(self):
+        while True:
+            row = await self._queue.get()
+            try:
+                await self._deliver(*row)
+            except Exception as e:
+                logger.error(f"Ошибка обработки очереди сообщений: {e}")
+            finally:
+                self._inflight.discard(row[0])
+                self._queue.task_done()
+
+    async def _send(self, method, chat_id, params):
+        handler = self._handlers.get(method)
+        if handler is not None:
+            return await handler(chat_id, **params)
+        return await getattr(self.bot, method)(chat_id=chat_id, **params)
+
+    async def _deliver(self, item_id, method, chat_id, params, attempts):
+        # Если лимит чата исчерпан, задание откладывается, а воркер
+        # освобождается для сообщений в другие чаты
+        chat_bucket = self.chat_buckets.get(chat_id)
+        if not chat_bucket.try_acquire():
+            await reschedule_outbox(item_id, attempts, time.time() + chat_bucket.delay())
+            return
+        await self.global_bucket.acquire()
+
+        try:
+            await self._send(method, chat_id, json.loads(params))
+        except TelegramRetryAfter as e:
+            chat_bucket.block(e.retry_after)
+            await reschedule_outbox(item_id, attempts, time.time() + e.retry_after)
+            return
+        except (TelegramNetworkError, TelegramServerError) as e:
+            attempts += 1
+            if attempts < self.max_attempts:
+                await reschedule_outbox(item_id, attempts, time.time() + min(2 ** attempts, 300))
+                return
+            logger.error(f"Не удалось отправить {method} в чат {chat_id} после {attempts} попыток: {e}")
+        except Exception as e:
+            logger.error(f"Не удалось отправить {method} в чат {chat_id}: {e}")
+
+        await delete_outbox(item_id)
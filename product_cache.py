@@ -0,0 +1,106 @@
+import asyncio
+import bisect
+import re
+import time
+
+from config import CATALOG_SYNC_INTERVAL, get_product_changes
+
+
+# Кэш товаров процесса. Каждое изменение товаров увеличивает версию каталога
+# в базе и помечает ею изменённую строку (удалённые товары попадают в
+# product_tombstones). Кэш не чаще check_interval сверяет версию и при её
+# изменении дочитывает только строки новее своей версии.
+class ProductCache:
+    def __init__(self, check_interval=CATALOG_SYNC_INTERVAL):
+        self.check_interval = check_interval
+        self.products = {}
+        self.version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+        # Индекс для поиска: слово названия/описания -> id товаров
+        self._words = {}
+        self._product_words = {}
+        self._sorted_words = None  # Отсортированные слова для поиска по префиксу
+
+    def get(self, product_id):
+        return self.products.get(product_id)
+
+    def _index(self, product_id, product):
+        self._unindex(product_id)
+        words = set(re.findall(r"\w+", f"{product['name']} {product['desc'] or ''}".lower()))
+        for word in words:
+            self._words.setdefault(word, set()).add(product_id)
+        self._product_words[product_id] = words
+        self._sorted_words = None
+
+    def _unindex(self, product_id):
+        for word in self._product_words.pop(product_id, ()):
+            ids = self._words[word]
+            ids.discard(product_id)
+            if not ids:
+                del self._words[word]
+        self._sorted_words = None
+
+    def _match_prefix(self, prefix):
+        if self._sorted_words is None:
+            self._sorted_words = sorted(self._words)
+        ids = set()
+        index = bisect.bisect_left(self._sorted_words, prefix)
+        while index < len(self._sorted_words) and self._sorted_words[index].startswith(prefix):
+            ids |= self._words[self._sorted_words[index]]
+            index += 1
+        return ids
+
+    # id товаров, у которых каждое слово запроса - начало какого-то слова
+    # названия или описания. Совпадения в названии идут первыми. Пустой
+    # запрос возвращает весь каталог.
+    def search(self, text):
+        terms = re.findall(r"\w+", text.lower())
+        if not terms:
+            return sorted(self.products)
+        found = None
+        for term in terms:
+            ids = self._match_prefix(term)
+            found = ids if found is None else found & ids
+            if not found:
+                return []
+
+        def rank(product_id):
+            name_words = re.findall(r"\w+", self.products[product_id]["name"].lower())
+            in_name = sum(any(word.startswith(term) for word in name_words) for term in terms)
+            return -in_name, product_id
+
+        return sorted(found, key=rank)
+
+    def __len__(self):
+        return len(self.products)
+
+    # Возвращает True, если кэш изменился
+    async def refresh(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return False
+        self._checked_at = now
+
+        async with self._lock:
+            # Первая загрузка читает весь каталог (версии строк не меньше 0)
+            changes = await get_product_changes(-1 if self.version is None else self.version)
+            if changes is None:
+                return False
+
+            version, rows, deleted_ids = changes
+            for row in rows:
+                self.products[row[0]] = {
+                    "name": row[1],
+                    "stars_price": row[2],
+                    "desc": row[3],
+                    "file_path": row[4],
+                    "file_id": row[5],
+                    "file_name": row[6]
+                }
+                self._index(row[0], self.products[row[0]])
+            for product_id in deleted_ids:
+                self.products.pop(product_id, None)
+                self._unindex(product_id)
+            self.version = version
+            return True
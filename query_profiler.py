@@ -0,0 +1,108 @@
+import logging
+import re
+import sqlite3
+import threading
+
+from config import SLOW_QUERY_THRESHOLD, add_query_observer, connect_db
+
+logger = logging.getLogger(__name__)
+
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDERS_RE = re.compile(r"\?(?:\s*,\s*\?)+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE")
+
+
+# Текст запроса без литералов и лишних пробелов: запросы, отличающиеся
+# только значениями, попадают в одну строку отчёта
+def normalize_query(query):
+    query = " ".join(query.split())
+    query = _STRING_RE.sub("?", query)
+    query = _NUMBER_RE.sub("?", query)
+    return _PLACEHOLDERS_RE.sub("?, ...", query)
+
+
+_normalized = {}
+
+
+# normalize_query с кэшем по исходному тексту. Размер кэша ограничен:
+# тексты с IN различаются длиной списка
+def normalized_query(query):
+    normalized = _normalized.get(query)
+    if normalized is None:
+        normalized = normalize_query(query)
+        if len(_normalized) < 10000:
+            _normalized[query] = normalized
+    return normalized
+
+
+# Профилировщик запросов: время каждого SQL-запроса суммируется по
+# нормализованному тексту. Запросы дольше threshold пишутся в журнал вместе
+# с планом выполнения (EXPLAIN QUERY PLAN).
+class QueryProfiler:
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD):
+        self.threshold = threshold
+        self._stats = {}  # запрос -> [количество, суммарное время, максимум, медленных]
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def install(self):
+        add_query_observer(self.observe)
+
+    # Вызывается в потоке базы сразу после выполнения запроса
+    def observe(self, query, seconds):
+        normalized = normalized_query(query)
+
+        slow = seconds >= self.threshold
+        with self._lock:
+            stats = self._stats.get(normalized)
+            if stats is None:
+                stats = self._stats[normalized] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            if slow:
+                stats[3] += 1
+
+        if slow:
+            plan = self.plan(query, normalized)
+            logger.warning(
+                f"Медленный запрос ({seconds * 1000:.1f} мс): {normalized}"
+                + (f"\nПлан: {'; '.join(plan)}" if plan else "")
+            )
+
+    # План запроса, один раз для каждого нормализованного текста
+    def plan(self, query, normalized):
+        if normalized in self._plans:
+            return self._plans[normalized]
+        if not normalized.upper().startswith(_EXPLAINABLE):
+            return None
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = connect_db(read_only=True)
+        try:
+            # Обычный курсор не уведомляет наблюдателей: EXPLAIN не попадает в статистику
+            rows = sqlite3.Cursor(conn).execute(
+                f"EXPLAIN QUERY PLAN {query}", [None] * query.count("?")
+            ).fetchall()
+            plan = [row[3] for row in rows]
+        except sqlite3.Error as e:
+            plan = [f"не удалось получить план: {e}"]
+        self._plans[normalized] = plan
+        return plan
+
+    # Самые тяжёлые запросы: (запрос, количество, всего с, среднее с, максимум с, медленных, план)
+    def top(self, n=10):
+        with self._lock:
+            items = [(query, *stats) for query, stats in self._stats.items()]
+        items.sort(key=lambda item: item[2], reverse=True)
+        return [
+            (query, count, total, total / count, longest, slow, self._plans.get(query))
+            for query, count, total, longest, slow in items[:n]
+        ]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+
+# Token bucket: rate токенов в секунду, не больше capacity в запасе
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    # Сколько секунд ждать до появления нужного количества токенов
+    def delay(self, tokens=1):
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        return max(0.0, (tokens - self.tokens) / self.rate)
+
+    async def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.delay(tokens))
+
+    # Полная блокировка на время, например по RetryAfter от Telegram
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    def idle_for(self, now):
+        return now - self.updated
+
+
+# Набор корзин по ключу (чат, пользователь). Давно не используемые
+# корзины удаляются, чтобы память не росла вместе с числом пользователей.
+class TokenBuckets:
+    def __init__(self, rate, capacity=None, ttl=60):
+        self.rate = rate
+        self.capacity = capacity
+        self.ttl = ttl
+        self._buckets = {}
+        self._last_sweep = time.monotonic()
+
+    def get(self, key):
+        now = time.monotonic()
+        if now - self._last_sweep > self.ttl:
+            self._sweep(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        return bucket
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        for key in [k for k, b in self._buckets.items() if b.idle_for(now) > self.ttl and now >= b.blocked_until]:
+            del self._buckets[key]
+
+    def __len__(self):
+        return len(self._buckets)
@@ -0,0 +1,125 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import queue
+
+from config import OUTBOX_GLOBAL_RATE, METRICS_PORT
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+# Номер процесса для апдейта. Апдейты одного пользователя всегда попадают
+# в один процесс и обрабатываются там по порядку.
+def shard_for(update, workers):
+    user = getattr(update.event, "from_user", None)
+    key = user.id if user else update.update_id
+    return key % workers
+
+
+# Супервизор: получает апдейты через long polling и раздаёт их процессам-
+# обработчикам. Общее состояние (товары, статистика, очередь сообщений, FSM)
+# процессы разделяют через базу данных.
+async def run_supervisor(bot, dp, workers):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue(maxsize=1000) for _ in range(workers)]
+    processes = [None] * workers
+
+    def ensure_workers():
+        for i in range(workers):
+            if processes[i] is None or not processes[i].is_alive():
+                if processes[i] is not None:
+                    logger.error(f"Процесс-обработчик {i} завершился с кодом {processes[i].exitcode}, перезапуск")
+                processes[i] = ctx.Process(target=_worker_main, args=(i, workers, queues[i]), daemon=True)
+                processes[i].start()
+
+    loop = asyncio.get_running_loop()
+    allowed_updates = dp.resolve_used_update_types()
+    offset = None
+    ensure_workers()
+    await bot.delete_webhook()
+    try:
+        while True:
+            try:
+                updates = await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+            except Exception as e:
+                logger.error(f"Ошибка получения апдейтов: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                offset = update.update_id + 1
+                target = queues[shard_for(update, workers)]
+                raw = update.model_dump_json(exclude_unset=True)
+                try:
+                    target.put_nowait(raw)
+                except queue.Full:
+                    await loop.run_in_executor(None, target.put, raw)
+            ensure_workers()
+    finally:
+        for q in queues:
+            q.put(None)
+        for process in processes:
+            process.join(timeout=10)
+
+
+def _worker_main(index, workers, updates):
+    logging.basicConfig(
+        level=logging.INFO,
+        format=f"%(asctime)s - worker{index} - %(name)s - %(levelname)s - %(message)s"
+    )
+    asyncio.run(_worker_loop(index, workers, updates))
+
+
+async def _worker_loop(index, workers, updates):
+    import bot as shop
+    from metrics import start_metrics_server
+
+    # Общий лимит Telegram делится между процессами
+    shop.outbox.global_bucket = TokenBucket(OUTBOX_GLOBAL_RATE / workers)
+    await shop.sync_catalog(force=True)
+    shop.outbox.start()
+    shop.broadcaster.start()
+    if METRICS_PORT:
+        await start_metrics_server(port=METRICS_PORT + index + 1)
+
+    loop = asyncio.get_running_loop()
+    chains = {}  # user_id -> последняя задача пользователя
+
+    async def process(previous, raw):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await shop.dp.feed_raw_update(shop.bot, raw)
+        except Exception as e:
+            logger.error(f"Ошибка обработки апдейта {raw.get('update_id')}: {e}")
+
+    def release(key, task):
+        if chains.get(key) is task:
+            del chains[key]
+
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, updates.get)
+            if raw is None:
+                break
+            raw = json.loads(raw)
+            key = _user_key(raw)
+            task = asyncio.create_task(process(chains.get(key), raw))
+            chains[key] = task
+            task.add_done_callback(lambda t, k=key: release(k, t))
+
+        if chains:
+            await asyncio.wait(list(chains.values()))
+    finally:
+        await shop.broadcaster.stop()
+        await shop.outbox.stop()
+        await shop.bot.session.close()
+
+
+def _user_key(raw):
+    for value in raw.values():
+        if isinstance(value, dict) and isinstance(value.get("from"), dict):
+            return value["from"].get("id")
+    return raw.get("update_id")
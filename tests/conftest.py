@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# config.py при импорте создаёт shop.db в текущей папке - тесты работают
+# с отдельной временной базой
+os.chdir(tempfile.mkdtemp(prefix="shop-tests-"))
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import StorageKey
+
+import config
+import fsm_storage
+from fsm_storage import SQLiteStorage, create_fsm_storage
+
+
+class Form(StatesGroup):
+    name = State()
+
+
+def storage_key(user_id):
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+async def fsm_row(key):
+    return await config.get_fsm_record(fsm_storage._make_key(key))
+
+
+def test_sqlite_state_and_data_round_trip():
+    async def run():
+        storage = SQLiteStorage()
+        key = storage_key(101)
+        await storage.set_state(key, Form.name)
+        await storage.set_data(key, {"name": "Товар", "price": 10})
+        # Новый экземпляр читает то же, что записал прежний: состояние в базе
+        other = SQLiteStorage()
+        return await other.get_state(key), await other.get_data(key)
+
+    assert asyncio.run(run()) == (Form.name.state, {"name": "Товар", "price": 10})
+
+
+def test_sqlite_clear_deletes_row():
+    async def run():
+        storage = SQLiteStorage()
+        key = storage_key(102)
+        context = FSMContext(storage, key)
+        await context.set_state(Form.name)
+        await context.update_data(name="Товар")
+        assert await fsm_row(key) is not None
+        await context.clear()
+        return await fsm_row(key), await storage.get_state(key), await storage.get_data(key)
+
+    assert asyncio.run(run()) == (None, None, {})
+
+
+def test_cleanup_removes_expired_states():
+    async def run():
+        storage = SQLiteStorage()
+        expired, fresh = storage_key(103), storage_key(104)
+        await storage.set_state(expired, Form.name)
+        await storage.set_state(fresh, Form.name)
+        await config.db_execute(
+            "UPDATE fsm_states SET updated_at = ? WHERE key = ?",
+            (time.time() - config.FSM_STATE_TTL - 60, fsm_storage._make_key(expired))
+        )
+        await config.cleanup_fsm_states(config.FSM_STATE_TTL)
+        return await fsm_row(expired), await storage.get_state(fresh)
+
+    assert asyncio.run(run()) == (None, Form.name.state)
+
+
+# Redis заменяется на fakeredis: проверяется выбор хранилища и TTL из настроек
+def test_create_redis_storage(monkeypatch):
+    pytest.importorskip("redis")
+    fakeredis = pytest.importorskip("fakeredis")
+    from aiogram.fsm.storage.redis import RedisStorage
+
+    monkeypatch.setattr(fsm_storage, "FSM_STORAGE", "redis")
+    storage = create_fsm_storage()
+    assert isinstance(storage, RedisStorage)
+    assert storage.state_ttl == storage.data_ttl == config.FSM_STATE_TTL
+
+    async def run():
+        storage.redis = fakeredis.FakeAsyncRedis()
+        key = storage_key(105)
+        await storage.set_state(key, Form.name)
+        await storage.set_data(key, {"name": "Товар"})
+        ttl = await storage.redis.ttl(storage.key_builder.build(key, "state"))
+        result = await storage.get_state(key), await storage.get_data(key), ttl
+        await storage.close()
+        return result
+
+    state, data, ttl = asyncio.run(run())
+    assert (state, data) == (Form.name.state, {"name": "Товар"})
+    assert 0 < ttl <= config.FSM_STATE_TTL
@@ -0,0 +1,16 @@
+import pytest
+
+import config
+
+
+# Каждый запрос из HOT_QUERIES на базе, созданной init_db(), должен
+# выполняться по индексу: без полного сканирования таблицы и без сортировки
+# во временном B-tree (кроме SORTED_QUERIES)
+@pytest.mark.parametrize("name", sorted(config.HOT_QUERIES))
+def test_query_uses_index(name):
+    assert config._check_query_plans({name: config.HOT_QUERIES[name]}) == []
+
+
+def test_check_detects_full_scan():
+    queries = {"full_scan": ("SELECT * FROM products WHERE desc = ?", ("",))}
+    assert config._check_query_plans(queries)
@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+import config
+from config import PURCHASE_DUPLICATE, PURCHASE_INSUFFICIENT, PURCHASE_OK, record_purchase
+
+PRODUCT_ID = 1
+
+
+def delivery():
+    return ("product_document", {"product_id": PRODUCT_ID, "caption": "c", "fallback_text": "f"})
+
+
+async def prepare_user(user_id, stars):
+    await config.add_user(user_id)
+    await config.add_stars(user_id, stars)
+
+
+async def purchase_count(user_id):
+    return (await config.db_fetchone("SELECT COUNT(*) FROM purchases WHERE user_id = ?", (user_id,)))[0]
+
+
+async def delivery_jobs(user_id):
+    rows = await config.db_fetchall(
+        "SELECT params FROM outbox WHERE method = 'product_document' AND chat_id = ?", (user_id,)
+    )
+    return [json.loads(row[0]) for row in rows]
+
+
+# Повтор с тем же ключом не списывает звёзды и не ставит выдачу второй раз
+def test_duplicate_idempotency_key():
+    async def run():
+        user_id = 201
+        await prepare_user(user_id, 100)
+        first = await record_purchase(user_id, PRODUCT_ID, 30, f"{user_id}:a", delivery())
+        second = await record_purchase(user_id, PRODUCT_ID, 30, f"{user_id}:a", delivery())
+        return (
+            first, second, await config.get_stars_balance(user_id),
+            await purchase_count(user_id), await delivery_jobs(user_id)
+        )
+
+    first, second, balance, purchases, jobs = asyncio.run(run())
+    assert (first, second) == (PURCHASE_OK, PURCHASE_DUPLICATE)
+    assert balance == 70
+    assert purchases == 1
+    assert [job["balance"] for job in jobs] == [70]
+
+
+# Нехватка звёзд откатывает вставку покупки: ключ можно использовать снова
+def test_insufficient_balance_rolls_back_purchase():
+    async def run():
+        user_id = 202
+        await prepare_user(user_id, 10)
+        result = await record_purchase(user_id, PRODUCT_ID, 30, f"{user_id}:a", delivery())
+        state = await config.get_stars_balance(user_id), await purchase_count(user_id), await delivery_jobs(user_id)
+        await config.add_stars(user_id, 20)
+        retry = await record_purchase(user_id, PRODUCT_ID, 30, f"{user_id}:a", delivery())
+        return result, state, retry
+
+    result, state, retry = asyncio.run(run())
+    assert result == PURCHASE_INSUFFICIENT
+    assert state == (10, 0, [])
+    assert retry == PURCHASE_OK
+
+
+# Два подтверждения одновременно с разными ключами: баланса хватает на одно
+def test_concurrent_confirms_debit_once():
+    async def run():
+        user_id = 203
+        await prepare_user(user_id, 50)
+        results = await asyncio.gather(
+            record_purchase(user_id, PRODUCT_ID, 30, f"{user_id}:a", delivery()),
+            record_purchase(user_id, PRODUCT_ID, 30, f"{user_id}:b", delivery()),
+        )
+        return (
+            sorted(results), await config.get_stars_balance(user_id),
+            await purchase_count(user_id), await delivery_jobs(user_id)
+        )
+
+    results, balance, purchases, jobs = asyncio.run(run())
+    assert results == sorted([PURCHASE_OK, PURCHASE_INSUFFICIENT])
+    assert balance == 20
+    assert purchases == 1
+    assert [job["balance"] for job in jobs] == [20]
@@ -0,0 +1,92 @@
+import asyncio
+from datetime import datetime
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message, Update, User
+from aiohttp.test_utils import TestClient, TestServer
+
+import config
+
+# bot.py создаёт Bot при импорте, а токен в config.py по умолчанию пустой
+config.TOKEN = "123456:TEST"
+import bot  # noqa: E402
+
+SECRET = "test-secret"
+
+
+# Сессия вместо Bot API: запоминает запросы и отвечает на отправку сообщений
+class FakeTelegramSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.requests = []
+
+    async def make_request(self, bot, method, timeout=None):
+        self.requests.append(method)
+        if isinstance(method, SendMessage):
+            return Message(
+                message_id=len(self.requests),
+                date=datetime.now(),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+def start_update(user_id):
+    return Update(
+        update_id=1,
+        message=Message(
+            message_id=1,
+            date=datetime.now(),
+            chat=Chat(id=user_id, type="private"),
+            from_user=User(id=user_id, is_bot=False, first_name="test"),
+            text="/start"
+        )
+    ).model_dump_json(exclude_none=True)
+
+
+async def post_update(headers):
+    session = FakeTelegramSession()
+    bot.bot.session = session
+    client = TestClient(TestServer(bot.create_webhook_app(secret_token=SECRET)))
+    await client.start_server()
+    try:
+        response = await client.post(
+            config.WEBHOOK_PATH,
+            data=start_update(1001),
+            headers={"Content-Type": "application/json", **headers}
+        )
+        # Апдейт обрабатывается в фоне после ответа Telegram
+        for _ in range(50):
+            if session.requests:
+                break
+            await asyncio.sleep(0.02)
+        return response.status, session.requests
+    finally:
+        await client.close()
+
+
+def test_webhook_accepts_update_with_secret():
+    status, requests = asyncio.run(post_update({"X-Telegram-Bot-Api-Secret-Token": SECRET}))
+    assert status == 200
+    assert [type(request) for request in requests] == [SendMessage]
+    assert requests[0].chat_id == 1001
+
+
+def test_webhook_rejects_update_without_secret():
+    status, requests = asyncio.run(post_update({}))
+    assert status == 401
+    assert requests == []
+
+
+def test_webhook_rejects_wrong_secret():
+    status, requests = asyncio.run(post_update({"X-Telegram-Bot-Api-Secret-Token": "wrong"}))
+    assert status == 401
+    assert requests == []
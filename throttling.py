@@ -0,0 +1,72 @@
+import logging
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import CallbackQuery, Message
+
+from config import (
+    ADMIN_IDS, THROTTLE_RATES, THROTTLE_DUPLICATE_WINDOW, THROTTLE_WARN_INTERVAL, THROTTLE_TTL
+)
+from ratelimit import TokenBuckets
+
+logger = logging.getLogger(__name__)
+
+
+# Ключи, встречавшиеся за последние window секунд. Повтор продлевает окно,
+# поэтому непрерывные повторы отбрасываются все. Старые ключи удаляются.
+class RecentKeys:
+    def __init__(self, window, sweep_interval=60):
+        self.window = window
+        self.sweep_interval = sweep_interval
+        self._seen = {}
+        self._last_sweep = time.monotonic()
+
+    def check(self, key):
+        now = time.monotonic()
+        if now - self._last_sweep > self.sweep_interval:
+            self._last_sweep = now
+            self._seen = {k: t for k, t in self._seen.items() if now - t < self.window}
+        seen = self._seen.get(key)
+        self._seen[key] = now
+        return seen is not None and now - seen < self.window
+
+
+# Ограничение частоты запросов пользователя. Подключается к message,
+# callback_query и inline_query как внутренний middleware, поэтому знает
+# выбранный обработчик и берёт корзину по его флагу throttling; флаг False
+# отключает ограничение (например, для платежей). Повторное нажатие той же
+# кнопки в течение duplicate_window отбрасывается до обработчика. Все данные
+# в памяти процесса: при WORKERS > 1 апдейты пользователя всегда попадают в
+# один процесс.
+class ThrottlingMiddleware(BaseMiddleware):
+    def __init__(self, rates=THROTTLE_RATES, duplicate_window=THROTTLE_DUPLICATE_WINDOW,
+                 warn_interval=THROTTLE_WARN_INTERVAL, ttl=THROTTLE_TTL, exempt=ADMIN_IDS):
+        self.buckets = {name: TokenBuckets(rate, capacity, ttl) for name, (rate, capacity) in rates.items()}
+        self.warnings = TokenBuckets(1 / warn_interval, 1, ttl)
+        self.recent_callbacks = RecentKeys(duplicate_window)
+        self.exempt = exempt
+
+    async def __call__(self, handler, event, data):
+        name = get_flag(data, "throttling", default="default")
+        user = data.get("event_from_user")
+        if name is False or user is None or user.id in self.exempt:
+            return await handler(event, data)
+
+        if isinstance(event, CallbackQuery) and self.recent_callbacks.check((user.id, event.data)):
+            await event.answer()
+            return None
+
+        buckets = self.buckets[name] if name in self.buckets else self.buckets["default"]
+        if buckets.get(user.id).try_acquire():
+            return await handler(event, data)
+
+        logger.debug(f"Ограничен запрос пользователя {user.id} ({name})")
+        # Предупреждение отправляется один раз, дальше запросы отбрасываются молча
+        warn = self.warnings.get(user.id).try_acquire()
+        text = "⏳ Слишком много запросов, подождите немного."
+        if isinstance(event, CallbackQuery):
+            await event.answer(text if warn else None)
+        elif isinstance(event, Message) and warn:
+            await event.answer(text)
+        return None
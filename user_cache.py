@@ -0,0 +1,78 @@
+import time
+from collections import OrderedDict
+
+
+# LRU-кэш строк пользователей: (stars_balance, notifications_enabled).
+# Функции config.py, меняющие баланс или настройки, кладут в кэш значения,
+# возвращённые самим UPDATE, поэтому чтения после записи не идут в базу.
+# Изменения из других процессов становятся видны не позже чем через ttl.
+class UserCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # user_id -> (stars_balance, notifications_enabled, истекает)
+        # Номер последней записи или сброса по пользователю; хранится ttl
+        # секунд, чтобы fill не вернул в кэш значение, прочитанное до них
+        self._counter = 0
+        self._changes = OrderedDict()  # user_id -> (номер, время)
+        self._cleared = 0  # Номер последнего полного сброса
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[2] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def _store(self, user_id, stars_balance, notifications_enabled):
+        self._entries[user_id] = (stars_balance, notifications_enabled, time.monotonic() + self.ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _changed(self, user_id):
+        now = time.monotonic()
+        self._counter += 1
+        self._changes[user_id] = (self._counter, now)
+        self._changes.move_to_end(user_id)
+        while self._changes and next(iter(self._changes.values()))[1] < now - self.ttl:
+            self._changes.popitem(last=False)
+
+    # Значения после записи в базу
+    def set(self, user_id, stars_balance, notifications_enabled):
+        self._changed(user_id)
+        self._store(user_id, stars_balance, notifications_enabled)
+
+    # Метка начала чтения из базы для fill
+    def token(self):
+        return self._counter
+
+    # Значения, прочитанные из базы после token(). Если за время чтения
+    # строку успели изменить или сбросить, прочитанное значение устарело
+    # и не сохраняется.
+    def fill(self, user_id, token, stars_balance, notifications_enabled):
+        if user_id in self._entries or token < self._cleared:
+            return
+        change = self._changes.get(user_id)
+        if change is not None and change[0] > token:
+            return
+        self._store(user_id, stars_balance, notifications_enabled)
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._counter += 1
+            self._cleared = self._counter
+            self._entries.clear()
+            self._changes.clear()
+        else:
+            self._changed(user_id)
+            self._entries.pop(user_id, None)
+
+    def __len__(self):
+        return len(self._entries)